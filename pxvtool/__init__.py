@@ -6,5 +6,13 @@ __all__ = [
     "fetch_spotlight_info",
     "download_ranking",
     "download_spotlight",
-    "filter_content"
+    "download_illust",
+    "download_plan",
+    "plan_ranking",
+    "plan_spotlight",
+    "filter_content",
+    "watch",
+    "set_bandwidth",
+    "load_shard_index",
+    "read_shard_member"
 ]
\ No newline at end of file
@@ -0,0 +1,421 @@
+import argparse
+import asyncio
+import datetime
+import importlib
+import json
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from . import pypxv
+from .warehouse import Warehouse
+
+try:
+    import tomllib as _toml
+except ImportError:
+    try:
+        import toml as _toml
+    except ImportError:
+        _toml = None
+
+#---------------------------------------------------------------------------#
+#   batch                                                                   #
+#       Run many rankings, spotlights and illust ids from one job file.     #
+#       Everything is planned first, illusts appearing in several jobs      #
+#       are downloaded once, then up to "JOB_LIMIT" jobs run at the same    #
+#       time on one connection pool and one post-processing pool.           #
+#---------------------------------------------------------------------------#
+#
+#   Job file, JSON or TOML:
+#
+#       savedir = "pixiv_image"
+#       warehouse = "pixiv_ranking.db"     # optional, see "Warehouse"
+#       cookies = "cookies.pickle"         # optional, for [[illust]]
+#       session_id = "..."                 # optional, for [[illust]]
+#       profile = "pxvprofile"             # optional, see "pypxv._Profiler"
+#
+#       [bandwidth]                        # optional, see "set_bandwidth"
+#       rate = 8388608
+#       schedule = [["09:00", "18:00", 2097152]]
+#
+#       [options]                          # defaults of every job
+#       hedge = true
+#       log_every = 50
+#       postprocess = ["mymodule:make_thumbnail"]
+#
+#       [[ranking]]
+#       dates = ["20181001", "20181002"]   # or date, or begin and end
+#       mode = "daily"
+#       content = "illust"
+#       top_n = 30                         # or ranks = [first, last]
+#       tags = ["landscape"]               # any of them
+#       exclude_tags = ["R-18"]
+#       min_views = 10000
+#       min_ratings = 1000
+#
+#       [[spotlight]]
+#       features = [3812, 3815]
+#
+#       [[illust]]
+#       ids = [70981001, 70981002]
+#       dirname = "Favorites"
+#
+#   Every entry also takes "dirname" and keys of [options], which override
+#   the defaults for that entry.
+
+#   Jobs running at the same time, they share "pypxv._sem" anyway.
+JOB_LIMIT = 4
+
+JOB_OPTIONS = [
+    "hedge", "log_file", "log_every", "archive", "shard_size",
+    "postprocess", "postprocess_workers", "skip_existing",
+    "bandwidth", "bandwidth_burst", "bandwidth_schedule"
+]
+
+#   Planned job, `items` are handed to "pypxv._chaining", `links` are
+#   (owner, illust_id) of illusts downloaded by job `owner` instead.
+JobPlan = namedtuple(
+    "JobPlan", ["name", "dirname", "items", "options", "links"]
+)
+JobResult = namedtuple(
+    "JobResult", ["name", "dirname", "files", "shared", "size", "elapsed"]
+)
+
+
+def load_job_file(path):
+    """
+    Load job file, TOML if its extension is ".toml", JSON otherwise.
+
+    Raises:
+        RuntimeError
+            Neither "tomllib" nor "toml" is available for TOML file.
+    """
+    with open(path, "rb") as f:
+        text = f.read().decode("utf-8")
+    if not path.endswith(".toml"):
+        return json.loads(text)
+    if _toml is None:
+        raise RuntimeError(
+            "TOML job file requires Python 3.11 or package 'toml'"
+        )
+    return _toml.loads(text)
+
+def run_batch(spec, *, savedir=""):
+    """
+    Plan and download every job in `spec`.
+
+    Args:
+        spec        `dict` or `str`
+            Deserialized job file, or its path, see top of this module.
+        savedir     `str`
+            Overrides "savedir" of job file.
+
+    Returns:
+        list of `JobResult`, in the order of jobs planned.
+
+    Raises:
+        aiohttp.ServerDisconnectedError
+            Too much concurrent connection or dense request
+            may result in this error.
+    """
+    if isinstance(spec, str):
+        spec = load_job_file(spec)
+    with pypxv._profiling(spec.get("profile"), spec.get("profile_cprofile")):
+        return pypxv._loop.run_until_complete(_run_batch(spec, savedir))
+
+async def _run_batch(spec, savedir):
+    savedir = savedir or spec.get("savedir", pypxv.DEFAULT_SAVEDIR)
+    defaults = _job_options(spec.get("options", dict()))
+    bandwidth = None
+    if spec.get("bandwidth"):
+        #   Restored once the batch ends.
+        bandwidth = pypxv._bandwidth.settings
+        pypxv.set_bandwidth(**spec["bandwidth"])
+    warehouse = None
+    if spec.get("warehouse"):
+        warehouse = Warehouse(spec["warehouse"])
+    cookies = spec.get("cookies")
+    jar = pypxv._make_cookie_jar(cookies, spec.get("session_id"))
+    start = time.perf_counter()
+    try:
+        async with pypxv._open_client(cookie_jar=jar) as client:
+            plans = await _plan(client, spec, savedir, defaults, warehouse)
+            plans = _dedup(plans)
+            pypxv.pxlog.info(
+                "Planned %d jobs, %d illusts, %d shared",
+                len(plans),
+                sum(len(p.items) for p in plans),
+                sum(len(p.links) for p in plans)
+            )
+            results = await _execute(client, plans)
+    finally:
+        if warehouse is not None:
+            warehouse.close()
+        if cookies:
+            jar.save(cookies)
+        if bandwidth is not None:
+            pypxv.set_bandwidth(**bandwidth)
+    elapsed = time.perf_counter() - start
+    total_size = sum(r.size for r in results)
+    pypxv.pxlog.info(
+        "Batch ok, %d files, %s in %.1f s, avg: %s/s",
+        sum(r.files for r in results), pypxv.byte2human(total_size),
+        elapsed, pypxv.byte2human(total_size / elapsed)
+    )
+    return results
+
+#---------------------------------------------------------------------------#
+#   Planning                                                                #
+#---------------------------------------------------------------------------#
+
+
+async def _plan(client, spec, savedir, defaults, warehouse):
+    """ Fetch metadata of every job entry at the same time. """
+    tasks = []
+    for entry in spec.get("ranking", []):
+        options = _entry_options(entry, defaults)
+        for date in _entry_dates(entry):
+            tasks.append(
+                _plan_ranking(client, entry, date, savedir, options, warehouse)
+            )
+    for entry in spec.get("spotlight", []):
+        options = _entry_options(entry, defaults)
+        features = entry.get("features") or [entry["feature"]]
+        for feature in features:
+            tasks.append(
+                _plan_spotlight(client, entry, feature, savedir, options)
+            )
+    for entry in spec.get("illust", []):
+        tasks.append(
+            _plan_illust(entry, savedir, _entry_options(entry, defaults))
+        )
+    gat = asyncio.gather(*tasks, loop=pypxv._loop)
+    try:
+        plans = await gat
+    except:
+        gat.cancel()
+        raise
+    return [p for p in plans if p is not None]
+
+async def _plan_ranking(client, entry, date, savedir, options, warehouse):
+    mode = entry.get("mode", "daily")
+    content = entry.get("content", "")
+    ranks = entry.get("ranks")
+    if entry.get("top_n", 0) > 0:
+        ranks = (1, entry["top_n"])
+    try:
+        date, metadatas = await pypxv._query_ranking_metas(
+            client, date, mode, content, entry.get("pages", -1),
+            ranks, entry.get("targets", ()), _make_predicates(entry),
+            warehouse
+        )
+    except Exception as err:
+        pypxv.pxlog.error("Ranking %s %s skipped: %s", mode, date, err)
+        return None
+    dirname = entry.get("dirname") or datetime.datetime.strptime(
+        date, "%Y%m%d"
+    ).strftime(pypxv.DEFAULT_FILEFMT)
+    return JobPlan(
+        f"ranking.{mode}", os.path.join(savedir, dirname), metadatas,
+        options, []
+    )
+
+async def _plan_spotlight(client, entry, feature, savedir, options):
+    texts = await pypxv._query_dispatcher(
+        pypxv.SPOTLIGHT_MAIN_URL, [{"article_id": feature}],
+        headers=pypxv.CAMOUFLAGE_HEADERS, client=client
+    )
+    js = json.loads(texts[0])
+    if js["error"]:
+        pypxv.pxlog.error("Spotlight %s skipped: %s", feature, js["message"])
+        return None
+    metadatas = list(
+        map(pypxv._make_illust_meta, js["body"][0]["illusts"])
+    )
+    dirname = entry.get("dirname") or f"Spotlight_{feature}"
+    return JobPlan(
+        "spotlight", os.path.join(savedir, dirname), metadatas, options, []
+    )
+
+async def _plan_illust(entry, savedir, options):
+    dirname = entry.get("dirname") or pypxv.DEFAULT_ILLUSTDIR
+    return JobPlan(
+        "illust", os.path.join(savedir, dirname), list(entry["ids"]),
+        options, []
+    )
+
+def _dedup(plans):
+    """ Keep every illust in the first job wants it, link it elsewhere. """
+    owners = dict()
+    deduped = []
+    for i, plan in enumerate(plans):
+        items = []
+        seen = set()
+        for item in plan.items:
+            key = pypxv._illust_key(item)
+            owner = owners.setdefault(key, i)
+            if owner != i:
+                plan.links.append((owner, key))
+            elif not (key in seen):
+                seen.add(key)
+                items.append(item)
+        deduped.append(plan._replace(items=items))
+    return deduped
+
+def _entry_dates(entry):
+    if entry.get("begin"):
+        end = entry.get("end") or pypxv._make_most_recent_date()
+        return list(pypxv._iter_dates(entry["begin"], end))
+    return entry.get("dates") or [entry.get("date", "")]
+
+def _entry_options(entry, defaults):
+    options = dict(defaults)
+    options.update(_job_options(entry))
+    return options
+
+def _job_options(entry):
+    options = {k: entry[k] for k in JOB_OPTIONS if k in entry}
+    if "postprocess" in options:
+        options["postprocess"] = [
+            _resolve_hook(h) for h in options["postprocess"]
+        ]
+    return options
+
+def _resolve_hook(name):
+    """ Import hook given as "module:function". """
+    module, _, func = name.partition(":")
+    return getattr(importlib.import_module(module), func)
+
+def _make_predicates(entry):
+    """ Ranking content filters of job entry. """
+    predicates = []
+    tags = set(entry.get("tags", ()))
+    exclude_tags = set(entry.get("exclude_tags", ()))
+    min_views = entry.get("min_views", 0)
+    min_ratings = entry.get("min_ratings", 0)
+    if tags:
+        predicates.append(lambda c: not tags.isdisjoint(c["tags"]))
+    if exclude_tags:
+        predicates.append(lambda c: exclude_tags.isdisjoint(c["tags"]))
+    if min_views:
+        predicates.append(lambda c: int(c["view_count"]) >= min_views)
+    if min_ratings:
+        predicates.append(lambda c: int(c["rating_count"]) >= min_ratings)
+    return predicates
+
+#---------------------------------------------------------------------------#
+#   Execution                                                               #
+#---------------------------------------------------------------------------#
+
+
+async def _execute(client, plans):
+    """ Run planned jobs on one client, "JOB_LIMIT" at a time.
+
+    Jobs share "pypxv._sem", so the connection limit holds for the whole
+    batch, and one process pool for post-processing. A job places its
+    linked illusts once the owner has finished downloading.
+    """
+    jobs = [None] * len(plans)
+    done = [asyncio.Event(loop=pypxv._loop) for _ in plans]
+    slots = asyncio.Semaphore(JOB_LIMIT, loop=pypxv._loop)
+    pool = None
+    hooked = [p.options for p in plans if p.options.get("postprocess")]
+    if hooked:
+        pool = ProcessPoolExecutor(
+            max(o.get("postprocess_workers") or 0 for o in hooked) or None
+        )
+    gat = asyncio.gather(
+        *(
+            _run_plan(client, i, plans, jobs, done, slots, pool)
+            for i in range(len(plans))
+        ),
+        loop=pypxv._loop
+    )
+    try:
+        return await gat
+    except:
+        gat.cancel()
+        raise
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+async def _run_plan(client, i, plans, jobs, done, slots, pool):
+    plan = plans[i]
+    #   Slot is only held while downloading, a job waiting for its owners
+    #   must not keep them from starting.
+    async with slots:
+        start = time.perf_counter()
+        job = pypxv._Job(
+            plan.dirname, name=plan.name, postprocess_pool=pool,
+            **plan.options
+        )
+        jobs[i] = job
+        try:
+            downloaded = await pypxv._chaining(plan.items, job, client)
+        except:
+            job.close()
+            raise
+        finally:
+            done[i].set()
+    try:
+        shared = 0
+        for owner, illust_id in plan.links:
+            await done[owner].wait()
+            source = jobs[owner].output
+            for name in pypxv._iter_held(source, illust_id):
+                job.output.share(source, name)
+                await pypxv._post_placed(job, name)
+                shared += 1
+        if job.post is not None:
+            await job.post.join(job.log)
+        elapsed = time.perf_counter() - start
+        size = sum(downloaded)
+        job.log.info(
+            "%s: %d files, %d shared, %s in %.1f s, avg: %s/s",
+            plan.dirname, sum(1 for d in downloaded if d), shared,
+            pypxv.byte2human(size), elapsed,
+            pypxv.byte2human(size / elapsed)
+        )
+    finally:
+        job.close()
+    return JobResult(
+        plan.name, plan.dirname, sum(1 for d in downloaded if d), shared,
+        size, elapsed
+    )
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="pxvtool",
+        description="Download pixiv rankings, spotlights and illusts "
+                    "listed in a JSON or TOML job file."
+    )
+    parser.add_argument("jobfile")
+    parser.add_argument(
+        "--savedir", default="", help="override savedir of job file"
+    )
+    parser.add_argument(
+        "--profile", default="", metavar="PATH",
+        help="profile the run, reports are written to PATH.*"
+    )
+    parser.add_argument(
+        "--cprofile", action="store_true", help="run cProfile as well"
+    )
+    args = parser.parse_args(argv)
+    spec = load_job_file(args.jobfile)
+    if args.profile:
+        spec["profile"] = args.profile
+        spec["profile_cprofile"] = args.cprofile
+    results = run_batch(spec, savedir=args.savedir)
+    for r in results:
+        print(
+            "{:40s} {:5d} files {:5d} shared {:>10s} {:7.1f} s".format(
+                r.dirname, r.files, r.shared, pypxv.byte2human(r.size),
+                r.elapsed
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
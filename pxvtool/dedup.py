@@ -0,0 +1,156 @@
+import argparse
+import json
+import os
+from collections import defaultdict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from . import pypxv
+from . import summary
+from . import verify
+
+#---------------------------------------------------------------------------#
+#   dedup                                                                   #
+#       Replace byte-identical downloads, e.g. the same illust in several   #
+#       date and spotlight folders, with hardlinks of one copy.             #
+#       Files are grouped by size first, only files sharing a size are      #
+#       hashed, in parallel.                                                #
+#---------------------------------------------------------------------------#
+
+DedupReport = namedtuple(
+    "DedupReport", ["files", "hashed", "groups", "linked", "reclaimed"]
+)
+
+
+def dedup_library(
+        root=pypxv.DEFAULT_SAVEDIR, *, workers=None, dry_run=False
+    ):
+    """
+    Find duplicated files under `root` and hardlink them to one copy.
+
+    Digests in the manifest of "verify.verify_library" are reused for files
+    unchanged since, the others are hashed with a process pool.
+
+    Args:
+        root        `str`
+            Download root, usually "savedir" of download functions.
+        workers     `int`
+            Number of processes, defaults to number of CPUs.
+        dry_run     `bool`
+            Only report, nothing is replaced.
+
+    Returns:
+        `DedupReport`, `reclaimed` is bytes freed, or to be freed if
+        `dry_run`.
+
+    Raises:
+        OSError
+            A duplicate could not be replaced.
+    """
+    paths = summary.find_matched(root, verify.regpxvfile)
+    manifest = _load_manifest(root)
+
+    #   Files of the same size on the same device are candidates, links of
+    #   the same inode are one file.
+    by_size = defaultdict(lambda: defaultdict(list))
+    stats = dict()
+    for path in paths:
+        st = os.stat(path)
+        if not st.st_size:
+            continue
+        stats[path] = st
+        by_size[(st.st_dev, st.st_size)][st.st_ino].append(path)
+
+    digests = dict()
+    pending = []
+    for inodes in by_size.values():
+        if len(inodes) < 2:
+            continue
+        for links in inodes.values():
+            path = links[0]
+            entry = manifest.get(os.path.relpath(path, root))
+            st = stats[path]
+            if (entry and entry["size"] == st.st_size
+                    and entry["mtime"] == st.st_mtime):
+                digests[path] = entry["sha256"]
+            else:
+                pending.append(path)
+
+    nproc = workers or os.cpu_count()
+    with ProcessPoolExecutor(workers) as pool:
+        results = pool.map(
+            verify.file_digest, pending,
+            chunksize=max(1, len(pending) // (nproc * 8))
+        )
+        for path, digest in results:
+            digests[path] = digest
+
+    groups = 0
+    linked = 0
+    reclaimed = 0
+    for (dev, size), inodes in by_size.items():
+        by_digest = defaultdict(list)
+        for links in inodes.values():
+            if links[0] in digests:
+                by_digest[digests[links[0]]].append(links)
+        for same in by_digest.values():
+            if len(same) < 2:
+                continue
+            groups += 1
+            #   The inode linked most is kept, fewer files are replaced.
+            same.sort(key=lambda links: len(links), reverse=True)
+            master = same[0][0]
+            for links in same[1:]:
+                for path in links:
+                    if not dry_run:
+                        _replace_with_link(master, path)
+                    linked += 1
+                #   Space is freed once every link of the inode is gone.
+                if stats[links[0]].st_nlink == len(links):
+                    reclaimed += size
+            pypxv.pxlog.debug("%s: %d copies", master, len(same))
+    report = DedupReport(len(paths), len(pending), groups, linked, reclaimed)
+    pypxv.pxlog.info(
+        "%d files, %d hashed, %d groups, %d linked, %s reclaimed",
+        report.files, report.hashed, report.groups, report.linked,
+        pypxv.byte2human(report.reclaimed)
+    )
+    return report
+
+def _load_manifest(root):
+    path = os.path.join(root, verify.MANIFEST_NAME)
+    if not os.path.exists(path):
+        return dict()
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def _replace_with_link(master, path):
+    """ Atomically replace `path` with a hardlink of `master`. """
+    tmpname = path + ".dedup"
+    os.link(master, tmpname)
+    try:
+        os.replace(tmpname, path)
+    except:
+        os.remove(tmpname)
+        raise
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Hardlink duplicated pixiv images."
+    )
+    parser.add_argument("root", nargs="?", default=pypxv.DEFAULT_SAVEDIR)
+    parser.add_argument("-j", "--workers", type=int, default=None)
+    parser.add_argument(
+        "-n", "--dry-run", action="store_true", help="only report"
+    )
+    args = parser.parse_args()
+    report = dedup_library(
+        args.root, workers=args.workers, dry_run=args.dry_run
+    )
+    print(
+        "Files {}, hashed {}, duplicated groups {}, linked {}, "
+        "reclaimed {}".format(
+            report.files, report.hashed, report.groups, report.linked,
+            pypxv.byte2human(report.reclaimed)
+        )
+    )
@@ -0,0 +1,484 @@
+import argparse
+import asyncio
+import functools
+import json
+import os
+import socket
+import sqlite3
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from . import pypxv
+
+#---------------------------------------------------------------------------#
+#   lease                                                                   #
+#       Share one download among several workers, possibly on different     #
+#       machines, through a SQLite work queue on shared storage.            #
+#       Every illust is claimed with an expiring lease, which is kept       #
+#       alive by heartbeats, so items of a dead worker are claimed again    #
+#       once the lease expires.                                             #
+#---------------------------------------------------------------------------#
+
+DEFAULT_WORK_QUEUE = "pxvqueue.db"
+# Seconds a claim is valid without heartbeat, heartbeats are sent every
+# third of it. Leases are compared in wall clock, keep clocks of workers
+# in sync well within it.
+LEASE_SECONDS = 300
+# Illusts claimed at once by a worker.
+LEASE_BATCH = pypxv.QUEUE_LIMIT
+# Seconds between polls while every item left is leased by others.
+LEASE_POLL = 10
+# An illust failed, or whose lease expired, "LEASE_MAX_ATTEMPTS" times is
+# given up.
+LEASE_MAX_ATTEMPTS = 3
+
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+
+_schema = """
+CREATE TABLE IF NOT EXISTS items (
+    dirname     TEXT,
+    illust_id   INTEGER,
+    task        TEXT,
+    payload     TEXT,
+    state       TEXT,
+    owner       TEXT,
+    expires     REAL,
+    attempts    INTEGER,
+    PRIMARY KEY (dirname, illust_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_items_state ON items (state, expires);
+"""
+
+
+class WorkQueue:
+    """ Illust-level work items claimed with expiring leases.
+
+    Items are keyed by (dirname, illust_id), enqueueing the same illust
+    again is ignored, so every file is wanted once only.
+
+    Calls may come from any thread, one at a time, workers make them from a
+    single background thread.
+    """
+    def __init__(self, path=DEFAULT_WORK_QUEUE):
+        self.path = path
+        #   Autocommit, transactions are opened explicitly.
+        self._conn = sqlite3.connect(
+            path, timeout=60, isolation_level=None, check_same_thread=False
+        )
+        self._conn.executescript(_schema)
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def enqueue(self, dirname, items, task="illust"):
+        """
+        Add illusts to be saved under `dirname`.
+
+        Args:
+            dirname     `str`
+                Output directory, on storage shared by workers.
+            items       `list`
+                `IllustMeta`, `IllustResolved` or illust_id, as taken by
+                "pypxv._chaining".
+            task        `str`
+                Name for logging.
+
+        Returns:
+            int, number of new items.
+
+        Raises:
+            None
+        """
+        rows = [
+            (dirname, pypxv._illust_key(i), task, json.dumps(_encode(i)),
+                PENDING, None, 0, 0)
+            for i in items
+        ]
+        with self._transaction():
+            before = self._count()
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO items VALUES (?,?,?,?,?,?,?,?)", rows
+            )
+            return self._count() - before
+
+    def enqueue_plan(self, plan):
+        """ Add illusts of "pypxv.plan_ranking", nothing is resolved again. """
+        return self.enqueue(
+            plan["dirname"], map(_decode, plan["illusts"]), plan["task"]
+        )
+
+    def claim(
+            self, worker, n=LEASE_BATCH, lease=LEASE_SECONDS,
+            max_attempts=LEASE_MAX_ATTEMPTS
+        ):
+        """
+        Lease at most `n` pending or expired items to `worker`.
+
+        An expired lease counts as a failed attempt, see "reclaim".
+
+        Returns:
+            list of tuple (dirname, task, item).
+        """
+        now = time.time()
+        with self._transaction():
+            self._expire(now, max_attempts)
+            rows = self._conn.execute(
+                "SELECT dirname, illust_id, task, payload FROM items "
+                "WHERE state=? LIMIT ?",
+                (PENDING, n)
+            ).fetchall()
+            self._conn.executemany(
+                "UPDATE items SET state=?, owner=?, expires=? "
+                "WHERE dirname=? AND illust_id=?",
+                (
+                    (LEASED, worker, now + lease, dirname, iid)
+                    for dirname, iid, _, _ in rows
+                )
+            )
+        return [
+            (dirname, task, _decode(json.loads(payload)))
+            for dirname, _, task, payload in rows
+        ]
+
+    def heartbeat(self, worker, keys, lease=LEASE_SECONDS):
+        """ Extend leases of (dirname, illust_id) `keys`, returns set of
+        keys still leased by `worker`. """
+        with self._transaction():
+            self._conn.executemany(
+                "UPDATE items SET expires=? "
+                "WHERE dirname=? AND illust_id=? AND state=? AND owner=?",
+                (
+                    (time.time() + lease, dirname, iid, LEASED, worker)
+                    for dirname, iid in keys
+                )
+            )
+            held = self._conn.execute(
+                "SELECT dirname, illust_id FROM items "
+                "WHERE state=? AND owner=?",
+                (LEASED, worker)
+            ).fetchall()
+        return set(keys).intersection(held)
+
+    def complete(self, worker, keys):
+        """ Mark `keys` leased by `worker` done. """
+        with self._transaction():
+            self._conn.executemany(
+                "UPDATE items SET state=?, expires=0 "
+                "WHERE dirname=? AND illust_id=? AND state=? AND owner=?",
+                (
+                    (DONE, dirname, iid, LEASED, worker)
+                    for dirname, iid in keys
+                )
+            )
+
+    def fail(self, worker, keys, max_attempts=LEASE_MAX_ATTEMPTS):
+        """ Release `keys` leased by `worker` for another attempt, or give
+        them up after `max_attempts`. """
+        with self._transaction():
+            self._conn.executemany(
+                "UPDATE items SET attempts=attempts+1, "
+                "state=CASE WHEN attempts+1>=? THEN ? ELSE ? END, "
+                "owner=NULL, expires=0 "
+                "WHERE dirname=? AND illust_id=? AND state=? AND owner=?",
+                (
+                    (max_attempts, FAILED, PENDING, dirname, iid, LEASED,
+                        worker)
+                    for dirname, iid in keys
+                )
+            )
+
+    def release(self, worker, keys):
+        """ Release `keys` leased by `worker` without counting an attempt. """
+        with self._transaction():
+            self._conn.executemany(
+                "UPDATE items SET state=?, owner=NULL, expires=0 "
+                "WHERE dirname=? AND illust_id=? AND state=? AND owner=?",
+                (
+                    (PENDING, dirname, iid, LEASED, worker)
+                    for dirname, iid in keys
+                )
+            )
+
+    def reclaim(self, max_attempts=LEASE_MAX_ATTEMPTS):
+        """ Release expired leases, each counts as a failed attempt, so an
+        illust crashing its workers is given up eventually. Returns number
+        of items released or given up. """
+        with self._transaction():
+            return self._expire(time.time(), max_attempts)
+
+    def _expire(self, now, max_attempts):
+        cur = self._conn.execute(
+            "UPDATE items SET attempts=attempts+1, "
+            "state=CASE WHEN attempts+1>=? THEN ? ELSE ? END, "
+            "owner=NULL, expires=0 "
+            "WHERE state=? AND expires<?",
+            (max_attempts, FAILED, PENDING, LEASED, now)
+        )
+        return cur.rowcount
+
+    def stats(self):
+        """ Number of items by state. """
+        return dict(
+            self._conn.execute(
+                "SELECT state, COUNT(*) FROM items GROUP BY state"
+            ).fetchall()
+        )
+
+    def unfinished(self):
+        """ Number of items pending or leased. """
+        return self._conn.execute(
+            "SELECT COUNT(*) FROM items WHERE state IN (?,?)",
+            (PENDING, LEASED)
+        ).fetchone()[0]
+
+    def _count(self):
+        return self._conn.execute("SELECT COUNT(*) FROM items").fetchone()[0]
+
+    def _transaction(self):
+        return _Transaction(self._conn)
+
+
+class _Transaction:
+    """ Write transaction, the database is locked from the start so claims
+    of different workers never overlap. """
+    def __init__(self, conn):
+        self._conn = conn
+
+    def __enter__(self):
+        self._conn.execute("BEGIN IMMEDIATE")
+
+    def __exit__(self, exc_type, *exc):
+        self._conn.execute("ROLLBACK" if exc_type else "COMMIT")
+
+
+def _encode(item):
+    if isinstance(item, pypxv.NewIllustResolved):
+        return dict(item.meta._asdict(), ext=item.ext)
+    if isinstance(item, pypxv.NewIllustMeta):
+        return item._asdict()
+    return {"illust_id": int(item)}
+
+def _decode(payload):
+    if not ("template_url" in payload):
+        return payload["illust_id"]
+    meta = pypxv.NewIllustMeta(
+        payload["illust_id"], payload["illust_page_count"],
+        payload["template_url"], pypxv.IllustType(payload["illust_type"])
+    )
+    if "ext" in payload:
+        return pypxv.NewIllustResolved(meta, payload["ext"])
+    return meta
+
+def default_worker_name():
+    return "{}:{}".format(socket.gethostname(), os.getpid())
+
+def run_worker(
+        path=DEFAULT_WORK_QUEUE, *,
+        worker="", batch=LEASE_BATCH, lease=LEASE_SECONDS, wait=False,
+        **options
+    ):
+    """
+    Download items of work queue until none is left.
+
+    Any number of workers may run on the same queue, each claims
+    `batch` illusts at a time and keeps them leased while downloading.
+    Illusts already saved in shared output are skipped.
+
+    Args:
+        path        `str`
+            SQLite file of "WorkQueue", on storage shared by workers.
+        worker      `str`
+            Name of this worker, defaults to "host:pid".
+        batch       `int`
+            Illusts claimed at once.
+        lease       `int`
+            Seconds a claim is valid without heartbeat.
+        wait        `bool`
+            Keep polling for new items instead of returning once the queue
+            is finished.
+        options
+            Keyword options of "pypxv._Job", such as `hedge`.
+
+    Returns:
+        tuple of (illusts done, bytes downloaded).
+
+    Raises:
+        aiohttp.ServerDisconnectedError
+            Too much concurrent connection or dense request
+            may result in this error.
+    """
+    options.setdefault("skip_existing", True)
+    with WorkQueue(path) as queue:
+        return pypxv._loop.run_until_complete(
+            _run_worker(
+                queue, worker or default_worker_name(), batch, lease, wait,
+                options
+            )
+        )
+
+async def _run_worker(queue, worker, batch, lease, wait, options):
+    log = pypxv.pxlog.getChild("worker")
+    log.info("Worker %s started on %s", worker, queue.path)
+    done = 0
+    total_size = 0
+    start = time.perf_counter()
+    #   SQLite blocks, queue is only touched from this thread.
+    executor = ThreadPoolExecutor(1)
+    call = functools.partial(_call, executor)
+    #   One job per output for the whole run, see "_run_claimed".
+    jobs = dict()
+    try:
+        async with pypxv._open_client() as client:
+            while True:
+                claimed = await call(queue.claim, worker, batch, lease)
+                if not claimed:
+                    if not wait and not await call(queue.unfinished):
+                        break
+                    #   Rest is leased by others, it is claimable again if
+                    #   they die.
+                    await asyncio.sleep(LEASE_POLL, loop=pypxv._loop)
+                    continue
+                n, size = await _run_claimed(
+                    client, queue, call, worker, claimed, lease, jobs,
+                    options
+                )
+                done += n
+                total_size += size
+    finally:
+        for job in jobs.values():
+            job.close()
+        executor.shutdown()
+    elapsed = time.perf_counter() - start
+    log.info(
+        "Worker %s done, %d illusts, %s in %.1f s, avg: %s/s",
+        worker, done, pypxv.byte2human(total_size), elapsed,
+        pypxv.byte2human(total_size / elapsed)
+    )
+    return done, total_size
+
+async def _call(executor, func, *args):
+    return await pypxv._loop.run_in_executor(
+        executor, functools.partial(func, *args)
+    )
+
+async def _run_claimed(
+        client, queue, call, worker, claimed, lease, jobs, options
+    ):
+    """ Download claimed items, returns (illusts done, bytes).
+
+    Lost leases are dropped before their illusts are started, if one
+    already started is lost, the batch is given up and the rest released.
+    """
+    keys = [(dirname, pypxv._illust_key(item)) for dirname, _, item in claimed]
+    groups = defaultdict(list)
+    for dirname, task, item in claimed:
+        groups[(dirname, task)].append(item)
+    lost = set()
+    started = set()
+
+    def feed(dirname, items):
+        for item in items:
+            key = (dirname, pypxv._illust_key(item))
+            if key in lost:
+                continue
+            started.add(key)
+            yield item
+
+    async def download():
+        size = 0
+        for (dirname, task), items in groups.items():
+            job = jobs.get((dirname, task))
+            if job is None:
+                job = pypxv._Job(dirname, name=task, **options)
+                jobs[(dirname, task)] = job
+            downloaded = await pypxv._chaining(
+                feed(dirname, items), job, client
+            )
+            size += sum(downloaded)
+        return size
+
+    work = pypxv._loop.create_task(download())
+    beat = pypxv._loop.create_task(
+        _heartbeat(queue, call, worker, keys, lease, lost, started, work)
+    )
+    total_size = 0
+    try:
+        total_size = await work
+    except asyncio.CancelledError:
+        #   Cancelled by "_heartbeat", or from outside.
+        if not (lost & started):
+            raise
+    finally:
+        beat.cancel()
+        finished = [
+            (dirname, pypxv._illust_key(item))
+            for dirname, task, item in claimed
+            if (dirname, task) in jobs
+            and _is_saved(jobs[(dirname, task)].output, item)
+        ]
+        await call(queue.complete, worker, finished)
+        done = set(finished)
+        rest = [k for k in keys if not (k in done)]
+        if lost & started:
+            #   Given up for a lost lease, not a failure of the rest.
+            await call(queue.release, worker, rest)
+        else:
+            #   Interrupted or not found, let another attempt take it.
+            await call(queue.fail, worker, rest)
+    return len(finished), total_size
+
+async def _heartbeat(queue, call, worker, keys, lease, lost, started, work):
+    while True:
+        await asyncio.sleep(lease / 3, loop=pypxv._loop)
+        held = await call(queue.heartbeat, worker, keys, lease)
+        gone = set(keys) - held - lost
+        if not gone:
+            continue
+        lost.update(gone)
+        pypxv.pxlog.warning("Worker %s lost %d leases", worker, len(gone))
+        if gone & started:
+            work.cancel()
+            return
+
+def _is_saved(output, item):
+    if isinstance(item, pypxv.NewIllustResolved):
+        item = item.meta
+    if isinstance(item, pypxv.NewIllustMeta):
+        return pypxv._is_held(output, item)
+    return next(pypxv._iter_held(output, item), None) is not None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Download illusts of a shared work queue."
+    )
+    parser.add_argument("queue", nargs="?", default=DEFAULT_WORK_QUEUE)
+    parser.add_argument(
+        "--plan", action="append", default=[],
+        help="enqueue a plan dumped by pypxv.plan_ranking before working"
+    )
+    parser.add_argument("--name", default="", help="name of this worker")
+    parser.add_argument("--batch", type=int, default=LEASE_BATCH)
+    parser.add_argument(
+        "--wait", action="store_true", help="keep polling for new items"
+    )
+    args = parser.parse_args()
+    with WorkQueue(args.queue) as wq:
+        for fname in args.plan:
+            with open(fname, "r", encoding="utf-8") as f:
+                print("Enqueued", wq.enqueue_plan(json.load(f)), "illusts")
+        wq.reclaim()
+    done, size = run_worker(
+        args.queue, worker=args.name, batch=args.batch, wait=args.wait
+    )
+    print("Done {} illusts, {}".format(done, pypxv.byte2human(size)))
@@ -1,20 +1,38 @@
 import asyncio
+import atexit
+import contextlib
+import contextvars
+import copy
+import cProfile
 import datetime
 import enum
+import functools
+import io
+import itertools
 import json
 import logging
+import logging.handlers
 import math
 import os
 import pytz
+import queue
 import random
 import re
+import shutil
 import sys
+import tarfile
+import tempfile
 import time
+import zipfile
+import urllib.parse
 
-from collections import namedtuple
+from collections import defaultdict, deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import aiohttp
 
+from yarl import URL
+
 
 #---------------------------------------------------------------------------#
 #   pypxv                                                                   #
@@ -40,16 +58,24 @@ class IllustType(_StrEnum):
 
 class HTTPStatus(enum.IntEnum):
     OK = 200
+    PARTIAL_CONTENT = 206
     NOT_FOUND = 404
 
 
+class IntegrityError(Exception):
+    """ Received file is incomplete or not a valid image. """
+
+
 RANKING_URL = "https://www.pixiv.net/ranking.php"
 SPOTLIGHT_MAIN_URL = "https://www.pixiv.net/ajax/showcase/article"
 SPOTLIGHT_QUERYLIST_URL = "https://www.pixiv.net/ajax/showcase/latest"
 
-UGOIRA_META_template = "https://www.pixiv.net/ajax/illust/{:8d}/ugoira_meta"
+UGOIRA_META_template = "https://www.pixiv.net/ajax/illust/{}/ugoira_meta"
+ILLUST_AJAX_template = "https://www.pixiv.net/ajax/illust/{}"
+PIXIV_URL = "https://www.pixiv.net/"
 
 DEFAULT_SAVEDIR = "pixiv_image"
+DEFAULT_ILLUSTDIR = "Illusts"
 DEFAULT_FILEFMT = "%Y_%m_%d"
 
 MODE_PAGE = {
@@ -60,6 +86,8 @@ MODE_PAGE = {
     "male": 10,
     "female": 10
 }
+#   Illusts per ranking page.
+RANKING_PAGE_SIZE = 50
 AVAILABLE_CONTENTS = [
     "illust", "manga", "ugoira"
 ]
@@ -88,6 +116,21 @@ ILLUST_ATTRS = [
     "yes_rank"
 ]
 COMMON_EXTS = ["jpg", "png", "gif", "bmp", "zip"]
+#   Leading magic bytes and trailer of each file format, the trailer is
+#   searched within the last "_TAIL_BYTES" of a file.
+#   Zip ends with "end of central directory" and an optional comment.
+_MAGICS = {
+    "jpg": ((b"\xff\xd8\xff",), b"\xff\xd9"),
+    "png": ((b"\x89PNG\r\n\x1a\n",), b"IEND\xaeB`\x82"),
+    "gif": ((b"GIF87a", b"GIF89a"), b"\x3b"),
+    "bmp": ((b"BM",), b""),
+    "zip": ((b"PK\x03\x04",), b"PK\x05\x06"),
+}
+_HEAD_BYTES = 16
+_TAIL_BYTES = {
+    "zip": 22 + 0xffff,
+}
+_DEFAULT_TAIL_BYTES = 64
 RANKING_REFERER = (
     "https://www.pixiv.net/member_illust.php?"
     "mode=medium&illust_id="
@@ -115,6 +158,87 @@ SPOTLIGHT_LIST_HEADERS = {
 # The concurrent level of connection.
 # Too many concurrent connection may cause you cut from server.
 SEM_LIMIT = 4
+# The number of items allowed to be queued ahead of workers, producers wait
+# once the queue is full, so memory usage is independent from job size.
+QUEUE_LIMIT = SEM_LIMIT * 4
+
+# Every download asks for the first "SEGMENT_THRESHOLD" bytes, the total
+# size is taken from its "Content-Range". If the file is larger, only an
+# even share of it, 1 / "SEGMENT_COUNT" and at most "SEGMENT_THRESHOLD"
+# bytes, is read from that response, the rest is split into
+# "SEGMENT_COUNT" - 1 more ranges fetched in parallel with the first one.
+# Each extra range is retried at most "SEGMENT_RETRY" times, resuming from
+# the last received byte.
+SEGMENT_THRESHOLD = 4 * 1024 * 1024
+SEGMENT_COUNT = SEM_LIMIT
+SEGMENT_RETRY = 3
+
+# A file failed integrity check is downloaded again, at most "VERIFY_RETRY"
+# times in total.
+VERIFY_RETRY = 3
+
+# Hedged requests, see "_Hedger".
+# A duplicate request is issued when the original has received no byte, or
+# is slower than "HEDGE_MIN_RATE" bytes/s, after the 95th percentile of
+# recent time-to-first-byte. Until "HEDGE_MIN_SAMPLES" are collected,
+# "HEDGE_DEFAULT_DELAY" seconds is used instead.
+# At most "HEDGE_RATIO" of requests plus "HEDGE_BURST" are hedged.
+HEDGE_RATIO = 0.05
+HEDGE_BURST = 2
+HEDGE_MIN_RATE = 32 * 1024
+HEDGE_MIN_SAMPLES = 20
+HEDGE_DEFAULT_DELAY = 1.0
+
+# Connections of a client. A download holds one "_sem" slot, but may open
+# "SEGMENT_COUNT" connections, extra ones must not queue behind other
+# downloads. "HEDGE_BURST" more are kept for duplicates of stalled
+# requests, which are issued while every slot is busy.
+CONN_LIMIT = SEM_LIMIT * SEGMENT_COUNT + HEDGE_BURST
+
+# Archive output, see "_ShardOutput".
+# A new shard is started once the current one reaches "SHARD_SIZE" bytes.
+# Each download is spooled in memory up to "SPOOL_LIMIT" bytes, or on a
+# temporary file beyond that, before being appended to the shard.
+# Every shard has its own index, named after the shard plus
+# "SHARD_INDEX_SUFFIX".
+ARCHIVE_FORMATS = ["tar", "zip"]
+SHARD_SIZE = 1024 ** 3
+SPOOL_LIMIT = 8 * 1024 * 1024
+SHARD_INDEX_SUFFIX = ".index.jsonl"
+
+# Watch mode, see "watch".
+# Rankings are published around "WATCH_PUBLISH_TIME" (hour, minute) in
+# Tokyo time. If a ranking is not published yet, check again after
+# "WATCH_RETRY_DELAY" seconds.
+WATCH_PUBLISH_TIME = (12, 5)
+WATCH_RETRY_DELAY = 600
+DEFAULT_WATCH_STATE = "pxvwatch.json"
+
+# Post-processing, see "_PostProcessor".
+# At most "POST_QUEUE_LIMIT" files are waiting for hooks, downloading waits
+# once it is reached. Files not larger than "POST_BUFFER_LIMIT" are handed
+# to hooks as in-memory buffer.
+POST_QUEUE_LIMIT = 16
+POST_BUFFER_LIMIT = 1024 * 1024
+
+# Bandwidth limit, see "_TokenBucket" and "set_bandwidth".
+# Unless given, a bucket holds "BANDWIDTH_BURST_SECONDS" worth of bytes at
+# its rate. Schedules are checked against local time every
+# "BANDWIDTH_SCHEDULE_CHECK" seconds.
+BANDWIDTH_BURST_SECONDS = 1.0
+BANDWIDTH_SCHEDULE_CHECK = 1.0
+
+# Profiling, see "_Profiler".
+# Event loop lag is sampled every "PROFILE_LAG_INTERVAL" seconds, the most
+# recent "PROFILE_LAG_SAMPLES" samples are kept for percentiles.
+PROFILE_LAG_INTERVAL = 0.1
+PROFILE_LAG_SAMPLES = 10000
+
+# Dry-run plans, see "plan_ranking".
+# Throughput of the last "THROUGHPUT_SAMPLES" downloaded plans is kept in
+# "THROUGHPUT_HISTORY" under savedir to estimate how long a plan takes.
+THROUGHPUT_HISTORY = "pxvthroughput.json"
+THROUGHPUT_SAMPLES = 20
 
 _logstrfmt = "{asctime}|{name}|{levelname:^7s}| {message}"
 _logtimefmt = "%H:%M:%S"
@@ -130,10 +254,30 @@ _console_hdl.setFormatter(_console_formatter)
 _file_hdl = logging.FileHandler(_logfile, "a+", "utf-8")
 _file_hdl.setFormatter(_file_formatter)
 
+
+
+class _LazyQueueHandler(logging.handlers.QueueHandler):
+    """ Enqueue records unformatted, formatting is left to the listener.
+
+    Every queue gets its own shallow copy, a record may reach listeners of
+    several queues, which format it at the same time.
+    """
+    def prepare(self, record):
+        return copy.copy(record)
+
+
+#   Records are only enqueued by the caller, handlers are run by a
+#   background thread so blocking I/O never happens in the event loop.
+_log_queue = queue.Queue()
+_log_listener = logging.handlers.QueueListener(
+    _log_queue, _console_hdl, _file_hdl, respect_handler_level=True
+)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
 _pxvroot = logging.getLogger("Pixiv")
 _pxvroot.setLevel(logging.INFO)
-_pxvroot.addHandler(_console_hdl)
-_pxvroot.addHandler(_file_hdl)
+_pxvroot.addHandler(_LazyQueueHandler(_log_queue))
 
 pxlog = _pxvroot    #   Alias
 
@@ -164,6 +308,582 @@ _origin_suf = {
 _loop = asyncio.get_event_loop()
 _sem = asyncio.Semaphore(SEM_LIMIT)
 
+#   Marks the end of a work queue.
+_STOP = object()
+
+
+class _SingleFlight:
+    """ Coalesce concurrent calls sharing the same key into one call. """
+    def __init__(self):
+        self._flights = dict()
+
+    async def do(self, key, func, *args):
+        """ Await `func(*args)`, or the call already in flight for `key`.
+
+        Returns a tuple of the result and whether it is shared from another
+        caller. Exceptions are shared as well.
+
+        The call runs as a task no caller owns, cancelling a caller, the
+        leading one included, never cancels it for the others. It is
+        cancelled once every caller has left.
+        """
+        flight = self._flights.get(key)
+        shared = flight is not None
+        if not shared:
+            flight = _Flight(_loop.create_task(func(*args)))
+            self._flights[key] = flight
+            flight.task.add_done_callback(
+                functools.partial(self._land, key, flight)
+            )
+        flight.waiters += 1
+        try:
+            res = await asyncio.shield(flight.task, loop=_loop)
+        finally:
+            flight.waiters -= 1
+            if not flight.waiters and not flight.task.done():
+                self._land(key, flight)
+                flight.task.cancel()
+        return res, shared
+
+    def _land(self, key, flight, task=None):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+        if task is not None and not task.cancelled():
+            #   Retrieved, it is raised to callers instead of being reported
+            #   as never retrieved.
+            task.exception()
+
+
+class _Flight:
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+
+#   Keyed by template url and by image url respectively, concurrent jobs
+#   containing the same illust share one request.
+_ext_flights = _SingleFlight()
+_dl_flights = _SingleFlight()
+
+
+class _Progress:
+    """ Progress of a single transfer. """
+    __slots__ = ("start", "first_byte", "received", "segmented")
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.first_byte = None
+        self.received = 0
+        self.segmented = False
+
+    def feed(self, n):
+        if self.first_byte is None:
+            self.first_byte = time.perf_counter()
+        self.received += n
+
+    def ttfb(self):
+        """ Time to first byte, or time waited so far if none received. """
+        end = self.first_byte or time.perf_counter()
+        return end - self.start
+
+
+class _Hedger:
+    """ Decide when and whether a slow request deserves a duplicate. """
+    def __init__(self, window=256):
+        self._samples = deque(maxlen=window)
+        self._requests = 0
+        self._hedges = 0
+
+    def record(self, progress):
+        self._requests += 1
+        if progress.first_byte is not None:
+            #   Time a cancelled straggler waited is not its ttfb.
+            self._samples.append(progress.ttfb())
+
+    def delay(self):
+        if len(self._samples) < HEDGE_MIN_SAMPLES:
+            return HEDGE_DEFAULT_DELAY
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+    def is_slow(self, progress):
+        if progress.segmented:
+            #   Never duplicate large files.
+            return False
+        if progress.first_byte is None:
+            return True
+        elapsed = time.perf_counter() - progress.first_byte
+        return elapsed > 0 and progress.received / elapsed < HEDGE_MIN_RATE
+
+    def acquire(self):
+        """ Take one hedge from budget, returns False if exhausted. """
+        if self._hedges >= self._requests * HEDGE_RATIO + HEDGE_BURST:
+            return False
+        self._hedges += 1
+        return True
+
+
+_hedger = _Hedger()
+
+
+class _TokenBucket:
+    """ Limit bytes per second of downloads sharing this bucket.
+
+    Tokens are refilled at the current rate, up to `burst` bytes. A chunk
+    takes its tokens as soon as it arrives and sleeps off any deficit, so
+    waiting is spread evenly over chunks instead of stalling once the
+    bucket runs dry.
+
+    `schedule` is a list of (start, end, rate), "HH:MM" in local time,
+    rate of the first window covering now overrides `rate`. Rate 0 means
+    unlimited.
+    """
+    def __init__(self, rate=0, burst=None, schedule=None):
+        self.configure(rate, burst, schedule)
+
+    def configure(self, rate=0, burst=None, schedule=None):
+        self._settings = dict(rate=rate, burst=burst, schedule=schedule)
+        self._base = rate
+        self._burst = burst
+        self._schedule = [
+            (_parse_clock(start), _parse_clock(end), r)
+            for start, end, r in schedule or ()
+        ]
+        self._checked = None
+        self._stamp = time.monotonic()
+        self._check_rate(self._stamp)
+        self._tokens = self._capacity()
+
+    @property
+    def rate(self):
+        return self._rate
+
+    @property
+    def settings(self):
+        """ Arguments of the last `configure`. """
+        return dict(self._settings)
+
+    def _capacity(self):
+        if self._burst is not None:
+            return self._burst
+        return self._rate * BANDWIDTH_BURST_SECONDS
+
+    def _check_rate(self, now):
+        if (self._checked is not None
+                and now - self._checked < BANDWIDTH_SCHEDULE_CHECK):
+            return
+        self._checked = now
+        self._rate = self._base
+        if not self._schedule:
+            return
+        local = datetime.datetime.now()
+        clock = (local.hour, local.minute)
+        for start, end, rate in self._schedule:
+            if _in_window(clock, start, end):
+                self._rate = rate
+                break
+
+    async def consume(self, n):
+        """ Take `n` bytes of tokens, wait if the bucket is in deficit. """
+        now = time.monotonic()
+        self._check_rate(now)
+        if not self._rate:
+            return
+        self._tokens = min(
+            self._capacity(), self._tokens + (now - self._stamp) * self._rate
+        )
+        self._stamp = now
+        self._tokens -= n
+        if self._tokens < 0:
+            await asyncio.sleep(-self._tokens / self._rate, loop=_loop)
+
+
+def _parse_clock(text):
+    hour, minute = text.split(":")
+    return int(hour), int(minute)
+
+def _in_window(clock, start, end):
+    if start <= end:
+        return start <= clock < end
+    #   Window across midnight.
+    return clock >= start or clock < end
+
+async def _throttle(limiters, n):
+    for bucket in limiters:
+        await bucket.consume(n)
+
+
+#   Shared by every download, see "set_bandwidth".
+_bandwidth = _TokenBucket()
+
+
+class _StageFrame:
+    __slots__ = ("path", "child")
+
+    def __init__(self, path):
+        self.path = path
+        self.child = 0.0
+
+
+class _Profiler:
+    """ Collect wall time of stages and event loop lag of a run.
+
+    Stages are functions decorated by "_staged", each call is accounted to
+    its stack of enclosing stages, which follows tasks spawned within.
+    Reports written by "write":
+        "{path}.folded"     Self time of stage stacks in microseconds, one
+                            "a;b;c count" per line, as taken by
+                            flamegraph.pl or speedscope.
+        "{path}.txt"        Calls and wall time per stage, loop lag.
+        "{path}.prof"       cProfile stats, if `cprofile` is set.
+    """
+    def __init__(self, cprofile=False):
+        self.stacks = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.wall = defaultdict(float)
+        self.lags = deque(maxlen=PROFILE_LAG_SAMPLES)
+        self.lag_count = 0
+        self.lag_max = 0.0
+        self._expected = None
+        self._handle = None
+        self._cprofile = cProfile.Profile() if cprofile else None
+
+    def start(self):
+        self._sample_lag()
+        if self._cprofile is not None:
+            self._cprofile.enable()
+
+    def stop(self):
+        if self._cprofile is not None:
+            self._cprofile.disable()
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def _sample_lag(self):
+        #   Lag is how late this callback runs than it is scheduled.
+        now = _loop.time()
+        if self._expected is not None:
+            lag = max(0.0, now - self._expected)
+            self.lags.append(lag)
+            self.lag_count += 1
+            self.lag_max = max(self.lag_max, lag)
+        self._expected = now + PROFILE_LAG_INTERVAL
+        self._handle = _loop.call_at(self._expected, self._sample_lag)
+
+    def record(self, frame, elapsed):
+        name = frame.path[-1]
+        self.calls[name] += 1
+        self.wall[name] += elapsed
+        #   Concurrent children may overlap, self time is never negative.
+        self.stacks[frame.path] += max(0.0, elapsed - frame.child)
+
+    def write(self, path):
+        with open(f"{path}.folded", "w", encoding="utf-8") as f:
+            for stack, seconds in sorted(self.stacks.items()):
+                f.write("{} {}\n".format(";".join(stack), int(seconds * 1e6)))
+        lags = sorted(self.lags)
+        lines = [
+            "{:24s} {:>8s} {:>10s} {:>10s}".format(
+                "stage", "calls", "wall (s)", "mean (ms)"
+            )
+        ]
+        for name, wall in sorted(
+                self.wall.items(), key=lambda x: x[1], reverse=True):
+            lines.append(
+                "{:24s} {:8d} {:10.2f} {:10.2f}".format(
+                    name, self.calls[name], wall,
+                    wall / self.calls[name] * 1e3
+                )
+            )
+        if lags:
+            lines.append(
+                "loop lag: {} samples, p50 {:.1f} ms, p95 {:.1f} ms, "
+                "p99 {:.1f} ms, max {:.1f} ms".format(
+                    self.lag_count,
+                    lags[len(lags) // 2] * 1e3,
+                    lags[min(len(lags) - 1, int(len(lags) * 0.95))] * 1e3,
+                    lags[min(len(lags) - 1, int(len(lags) * 0.99))] * 1e3,
+                    self.lag_max * 1e3
+                )
+            )
+        with open(f"{path}.txt", "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        if self._cprofile is not None:
+            self._cprofile.dump_stats(f"{path}.prof")
+        pxlog.info("Profile written to %s.*", path)
+
+
+#   Active profiler, None if profiling is off.
+_profiler = None
+#   Innermost stage of current task.
+_stage = contextvars.ContextVar("pxv_stage", default=None)
+
+@contextlib.contextmanager
+def _profiling(path, cprofile=False):
+    """ Profile everything run within, reports are written to `path`. """
+    global _profiler
+    if not path or _profiler is not None:
+        #   Off, or already profiled by an outer call.
+        yield _profiler
+        return
+    prof = _Profiler(cprofile)
+    _profiler = prof
+    prof.start()
+    try:
+        yield prof
+    finally:
+        prof.stop()
+        _profiler = None
+        prof.write(path)
+
+def _staged(func):
+    """ Account wall time of `func` to the active profiler. """
+    name = func.__name__
+
+    def enter():
+        parent = _stage.get()
+        path = (parent.path if parent is not None else ("pxvtool",))
+        frame = _StageFrame(path + (name,))
+        return parent, frame, _stage.set(frame), time.perf_counter()
+
+    def leave(prof, parent, frame, token, start):
+        elapsed = time.perf_counter() - start
+        _stage.reset(token)
+        if parent is not None:
+            parent.child += elapsed
+        prof.record(frame, elapsed)
+
+    if asyncio.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            prof = _profiler
+            if prof is None:
+                return await func(*args, **kwargs)
+            state = enter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                leave(prof, *state)
+    else:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            prof = _profiler
+            if prof is None:
+                return func(*args, **kwargs)
+            state = enter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                leave(prof, *state)
+    return wrapper
+
+
+class _Job:
+    """ Options and states of a single download job.
+
+    Messages of a job are logged through `log`, if `log_file` is given they
+    are written there as well. If `log_every` is set, one summary line per
+    `log_every` files is logged instead of one line per file.
+
+    Keyword options, taken by every download function:
+        hedge       `bool`
+            Issue a duplicate request for downloads that stall, the first
+            finished one is kept. See "HEDGE_RATIO".
+        log_file    `str`
+            Extra log file receiving messages of this job only.
+        log_every   `int`
+            If positive, log one summary line per `log_every` files instead
+            of one line per file.
+        archive     `str`
+            If given, stream files into rolling shards of this format
+            instead of saving loose files, see "ARCHIVE_FORMATS".
+        shard_size  `int`
+            Size in bytes a shard is rolled over at.
+        postprocess `list`
+            Functions called as `func(name, path, data)` on every saved
+            file in a process pool while downloading continues.
+            See "_PostProcessor".
+        postprocess_workers `int`
+            Number of processes for `postprocess`, defaults to CPU count.
+        bandwidth   `int`
+            If positive, bytes per second this job is limited to, on
+            top of the global limit, see "set_bandwidth".
+        bandwidth_burst `int`
+            Bytes allowed above `bandwidth` in a burst.
+        bandwidth_schedule `list`
+            Time-of-day rates overriding `bandwidth`, see "_TokenBucket".
+        skip_existing `bool`
+            Skip illusts whose last page is already saved.
+        postprocess_pool `concurrent.futures.ProcessPoolExecutor`
+            Run `postprocess` in this pool shared with other jobs, instead
+            of a pool of the job's own.
+    """
+    _count = 0
+
+    def __init__(
+            self, dirname, *,
+            name="job", hedge=False, log_file=None, log_every=0,
+            archive=None, shard_size=SHARD_SIZE,
+            postprocess=None, postprocess_workers=None, skip_existing=False,
+            bandwidth=0, bandwidth_burst=None, bandwidth_schedule=None,
+            postprocess_pool=None
+        ):
+        _Job._count += 1
+        self.id = _Job._count
+        self.dirname = dirname
+        if archive:
+            self.output = _ShardOutput(dirname, archive, shard_size)
+        else:
+            self.output = _FileOutput(dirname)
+        self.hedge = hedge
+        self.skip_existing = skip_existing
+        #   Every chunk is taken from global bucket, then job bucket.
+        self.limiters = [_bandwidth]
+        if bandwidth or bandwidth_schedule:
+            self.limiters.append(
+                _TokenBucket(bandwidth, bandwidth_burst, bandwidth_schedule)
+            )
+        self.post = None
+        if postprocess:
+            self.post = _PostProcessor(
+                postprocess, postprocess_workers, postprocess_pool
+            )
+        self.log_every = log_every
+        self._files = 0
+        self._bytes = 0
+        self._start = time.perf_counter()
+        self._sink = None
+        logger = pxlog.getChild(name)
+        self.log = logging.LoggerAdapter(logger, {"job": self.id})
+        if log_file:
+            self._sink = _JobSink(logger, self.id, log_file)
+
+    def report(self, name, size, elapsed):
+        """ Report a finished file. """
+        if not self.log_every:
+            if self.log.isEnabledFor(logging.INFO):
+                self.log.info(
+                    "%-14s %-10s %4.1f s", name, byte2human(size), elapsed
+                )
+            return
+        self._files += 1
+        self._bytes += size
+        if self._files >= self.log_every:
+            self.flush_report()
+
+    def flush_report(self):
+        """ Log aggregated files since last summary line. """
+        if not self._files:
+            return
+        elapsed = time.perf_counter() - self._start
+        self.log.info(
+            "%d files, %s in %.1f s",
+            self._files, byte2human(self._bytes), elapsed
+        )
+        self._files = 0
+        self._bytes = 0
+        self._start = time.perf_counter()
+
+    def close(self):
+        self.flush_report()
+        self.output.close()
+        if self.post is not None:
+            self.post.close()
+        if self._sink is not None:
+            self._sink.close()
+            self._sink = None
+
+
+class _PostProcessor:
+    """ Run user hooks on finished files with a process pool.
+
+    Every hook is called as `hook(name, path, data)` in a worker process,
+    `path` is None for archive output, `data` is the file content if it is
+    small enough or `path` is None. Hooks must be picklable, i.e. functions
+    defined at module level.
+
+    Files finished while a connection is held are only `defer`red, they are
+    submitted by `flush` once the connection is released. If `pool` is
+    given, it is shared with other jobs and left running by `close`.
+    """
+    def __init__(self, hooks, workers=None, pool=None):
+        self.hooks = list(hooks)
+        self._owned = pool is None
+        self._pool = ProcessPoolExecutor(workers) if pool is None else pool
+        self._slots = asyncio.Semaphore(POST_QUEUE_LIMIT, loop=_loop)
+        self._pending = set()
+        self._deferred = deque()
+
+    def wants_data(self, path, size):
+        return path is None or size <= POST_BUFFER_LIMIT
+
+    async def submit(self, name, path, data, log=pxlog):
+        """ Queue a file for hooks, waits if too many are pending. """
+        await self._slots.acquire()
+        fut = _loop.run_in_executor(
+            self._pool, _run_hooks, self.hooks, name, path, data
+        )
+        self._pending.add(fut)
+
+        def done(fut):
+            self._pending.discard(fut)
+            self._slots.release()
+            if not fut.cancelled() and fut.exception() is not None:
+                log.error(
+                    "Post-processing %s failed: %r", name, fut.exception()
+                )
+
+        fut.add_done_callback(done)
+
+    def defer(self, name, path, data):
+        """ Keep a file for the next `flush`, never waits. """
+        self._deferred.append((name, path, data))
+
+    async def flush(self, log=pxlog):
+        """ Submit deferred files. """
+        while self._deferred:
+            await self.submit(*self._deferred.popleft(), log)
+
+    async def join(self, log=pxlog):
+        """ Submit deferred files and wait for pending hooks. """
+        await self.flush(log)
+        if self._pending:
+            await asyncio.wait(self._pending, loop=_loop)
+
+    def close(self):
+        if self._owned:
+            self._pool.shutdown()
+
+
+def _run_hooks(hooks, name, path, data):
+    for hook in hooks:
+        hook(name, path, data)
+
+
+class _JobSink:
+    """ Per job log file, drained by its own background thread. """
+    def __init__(self, logger, job_id, log_file):
+        self._logger = logger
+        fhdl = logging.FileHandler(log_file, "a+", "utf-8")
+        fhdl.setFormatter(_file_formatter)
+        self._queue = queue.Queue()
+        self._listener = logging.handlers.QueueListener(self._queue, fhdl)
+        self._handler = _LazyQueueHandler(self._queue)
+        self._handler.addFilter(
+            lambda record: getattr(record, "job", None) == job_id
+        )
+        self._fhdl = fhdl
+        logger.addHandler(self._handler)
+        self._listener.start()
+
+    def close(self):
+        self._logger.removeHandler(self._handler)
+        self._listener.stop()
+        self._fhdl.close()
+
 
 # Use "TCPConnector" instead of semaphore and delay?
 # Pixiv limits either concurrent connections or connection interval?
@@ -201,6 +921,16 @@ NewIllustDerived = namedtuple(
     "IllustDerived", _illust_derived_fields
 )
 
+#   An illust with its file extension resolved, pages are not expanded
+#   until they are about to be fetched, see "_iter_pages".
+_illust_resolved_fields = [
+    "meta",                 #   IllustMeta
+    "ext"                   #   str
+]
+NewIllustResolved = namedtuple(
+    "IllustResolved", _illust_resolved_fields
+)
+
 _pattern_table = {
     IllustType.ILLUST: (_pat_thumbnail_mid, _pat_thumbnail_suf),
     IllustType.MANGA: (_pat_thumbnail_mid, _pat_thumbnail_suf),
@@ -239,19 +969,26 @@ def _make_illust_meta(content):
             illust_type
         )
 
-def _make_derived_fields(meta, ext):
-    deriveds = list()
-    tmp_url = str()
+def _make_derived(meta, ext, page):
+    """ Make derived field of single page. """
+    url = meta.template_url.format(illust_id=meta.illust_id, page=page)
+    return NewIllustDerived(
+        "{illust_id}_p{page}".format(illust_id=meta.illust_id, page=page),
+        f"{url}.{ext}", ext
+    )
+
+def _iter_derived_fields(meta, ext):
     for i in range(meta.illust_page_count):
-        tmp_url = meta.template_url.format(illust_id=meta.illust_id, page=i)
-        tmp_url += f".{ext}"
-        deriveds.append(
-            NewIllustDerived(
-                "{illust_id}_p{page}".format(illust_id=meta.illust_id, page=i),
-                tmp_url, ext
-            )
-        )
-    return deriveds
+        yield _make_derived(meta, ext, i)
+
+def _make_derived_fields(meta, ext):
+    return list(_iter_derived_fields(meta, ext))
+
+def _iter_pages(resolveds):
+    """ Expand resolved illusts into (resolved, page) pairs lazily. """
+    for r in resolveds:
+        for i in range(r.meta.illust_page_count):
+            yield r, i
 
 def _make_sample_url(meta, ext):
     sample = meta.template_url.format(illust_id=meta.illust_id, page=0)
@@ -274,33 +1011,279 @@ def _tear_down(origin_url, pages=1):
     Raises:
         `None`
     """
-    template = re.sub(
-        r"_p\d+", r"_p{page}", origin_url
-    )
+    return _make_derived_fields(*_tear_down_resolved(origin_url, pages))
+
+def _tear_down_resolved(origin_url, pages=1, illust_type=IllustType.ILLUST):
+    """ Make `IllustResolved` from original url, no probing is required.
+
+    Args:
+        origin_url      `str`
+            The original url of image, or zip of ugoira.
+        pages           `int`
+            Page count of illust
+        illust_type     `str`
+            See "IllustType".
+
+    Returns:
+        `IllustResolved`
+
+    Raises:
+        `None`
+    """
     m = re.search(
-        r"(?P<illust_id>\d+)_p\d+\.(?P<format>\w+)",
+        r"(?P<illust_id>\d+)_(?:p\d+|ugoira\w+)\.(?P<format>\w+)$",
         origin_url
     )
-    
     iid = m.group("illust_id")
     fmt = m.group("format")
-    deriveds = list(
-        map(
-            lambda args: NewIllustDerived(*args),
+    template = re.sub(
+        r"_p\d+$", r"_p{page}", origin_url[:-len(fmt) - 1]
+    )
+    return NewIllustResolved(
+        NewIllustMeta(int(iid), pages, template, illust_type), fmt
+    )
+
+#---------------------------------------------------------------------------#
+#   Output backends                                                         #
+#       Downloads are written to "sink.file" of "output.create(name)",      #
+#       then the sink is either committed or aborted.                       #
+#---------------------------------------------------------------------------#
+
+
+_part_seq = itertools.count()
+
+
+class _FileSink:
+    """ Write to a temporary name, renamed to `path` once committed. """
+    def __init__(self, path):
+        self.path = path
+        self._tmpname = "{}.{}.part".format(path, next(_part_seq))
+        self.file = open(self._tmpname, "w+b")
+
+    def commit(self):
+        self.file.close()
+        os.replace(self._tmpname, self.path)
+
+    def abort(self):
+        self.file.close()
+        if os.path.exists(self._tmpname):
+            os.remove(self._tmpname)
+
+
+class _FileOutput:
+    """ Save every file under `dirname`. """
+    def __init__(self, dirname):
+        self.dirname = dirname
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+    def create(self, name):
+        return _FileSink(os.path.join(self.dirname, name))
+
+    def exists(self, name):
+        return os.path.exists(os.path.join(self.dirname, name))
+
+    def open(self, name):
+        return open(os.path.join(self.dirname, name), "rb")
+
+    def path(self, name):
+        return os.path.join(self.dirname, name)
+
+    def share(self, source, name):
+        """ Place file `name` already saved by output `source`. """
+        if not isinstance(source, _FileOutput):
+            _copy_member(source, self, name)
+            return
+        src = os.path.join(source.dirname, name)
+        dst = os.path.join(self.dirname, name)
+        if src != dst:
+            _share_file(src, dst)
+
+    def close(self):
+        pass
+
+
+class _ShardSink:
+    """ Spool a download, appended to the shard once committed. """
+    def __init__(self, output, name):
+        self._output = output
+        self.name = name
+        self.path = None
+        self.file = tempfile.SpooledTemporaryFile(SPOOL_LIMIT)
+
+    def commit(self):
+        try:
+            self._output.append(self.name, self.file)
+        finally:
+            self.file.close()
+
+    def abort(self):
+        self.file.close()
+
+
+class _ShardOutput:
+    """ Append files into rolling tar or zip shards under `dirname`.
+
+    Files are stored uncompressed, index of a shard maps "illust_id_pN" to
+    the shard, data offset and size, see "read_shard_member".
+
+    Any number of outputs, in this or other processes, may write to the
+    same directory. A shard is created exclusively, only its creator writes
+    to it and its index.
+    """
+    def __init__(self, dirname, fmt="tar", shard_size=SHARD_SIZE):
+        if not (fmt in ARCHIVE_FORMATS):
+            raise ValueError(f"Unknown archive format: {fmt}")
+        self.dirname = dirname
+        self.fmt = fmt
+        self.shard_size = shard_size
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        self._index = load_shard_index(dirname)
+        #   Never touch shards of previous runs, continue with a new one.
+        self._seq = max(
             (
-                (iid, template.format(page=i), fmt)
-                for i in range(pages)
-            )
+                int(m.group(1))
+                for m in map(_pat_shard.match, os.listdir(dirname))
+                if m
+            ),
+            default=-1
+        ) + 1
+        self._fp = None
+        self._shard = None
+        self._shard_name = ""
+        self._index_file = None
+
+    def create(self, name):
+        return _ShardSink(self, name)
+
+    def exists(self, name):
+        return _shard_key(name) in self._index
+
+    def open(self, name):
+        if self._fp is not None:
+            self._fp.flush()
+        entry = self._index[_shard_key(name)]
+        return io.BytesIO(_read_shard_entry(self.dirname, entry))
+
+    def path(self, name):
+        """ Members have no path of their own. """
+        return None
+
+    def share(self, source, name):
+        _copy_member(source, self, name)
+
+    def append(self, name, f):
+        size = f.seek(0, io.SEEK_END)
+        f.seek(0)
+        if self._shard is None or self._fp.tell() >= self.shard_size:
+            self._roll()
+        if self.fmt == "tar":
+            offset = self._append_tar(name, f, size)
+        else:
+            offset = self._append_zip(name, f, size)
+        entry = {
+            "key": _shard_key(name),
+            "name": name,
+            "shard": self._shard_name,
+            "offset": offset,
+            "size": size
+        }
+        self._index[entry["key"]] = entry
+        self._index_file.write(json.dumps(entry) + "\n")
+        self._index_file.flush()
+
+    def _append_tar(self, name, f, size):
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = time.time()
+        header = info.tobuf(
+            self._shard.format, self._shard.encoding, self._shard.errors
+        )
+        offset = self._shard.offset + len(header)
+        self._shard.addfile(info, f)
+        return offset
+
+    def _append_zip(self, name, f, size):
+        info = zipfile.ZipInfo(name, time.localtime()[:6])
+        info.file_size = size
+        with self._shard.open(info, "w") as w:
+            #   Local header is written on open, data starts right here.
+            offset = self._fp.tell()
+            shutil.copyfileobj(f, w)
+        return offset
+
+    def _roll(self):
+        self._close_shard()
+        flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL
+        flags |= getattr(os, "O_BINARY", 0)
+        while True:
+            name = "shard_{:05d}.{}".format(self._seq, self.fmt)
+            self._seq += 1
+            try:
+                fd = os.open(os.path.join(self.dirname, name), flags, 0o666)
+            except FileExistsError:
+                #   Taken by another writer, try the next number.
+                continue
+            break
+        self._shard_name = name
+        self._fp = os.fdopen(fd, "wb")
+        self._index_file = open(
+            os.path.join(self.dirname, name + SHARD_INDEX_SUFFIX), "a",
+            encoding="utf-8"
         )
+        if self.fmt == "tar":
+            self._shard = tarfile.open(fileobj=self._fp, mode="w")
+        else:
+            self._shard = zipfile.ZipFile(self._fp, "w", zipfile.ZIP_STORED)
+
+    def _close_shard(self):
+        if self._shard is not None:
+            self._shard.close()
+            self._fp.close()
+            self._index_file.close()
+            self._shard = None
+            self._fp = None
+            self._index_file = None
+
+    def close(self):
+        self._close_shard()
+
+
+_pat_shard = re.compile(r"shard_(\d+)\.(?:{})$".format("|".join(ARCHIVE_FORMATS)))
+_pat_shard_index = re.compile(
+    r"shard_\d+\.(?:{}){}$".format(
+        "|".join(ARCHIVE_FORMATS), re.escape(SHARD_INDEX_SUFFIX)
     )
-    return deriveds
+)
+
+def _shard_key(name):
+    return name.rsplit(".", maxsplit=1)[0]
+
+def _read_shard_entry(dirname, entry):
+    with open(os.path.join(dirname, entry["shard"]), "rb") as f:
+        f.seek(entry["offset"])
+        return f.read(entry["size"])
+
+def _copy_member(source, output, name):
+    """ Copy file `name` from output `source` into `output`. """
+    sink = output.create(name)
+    try:
+        with source.open(name) as f:
+            shutil.copyfileobj(f, sink.file)
+    except:
+        sink.abort()
+        raise
+    sink.commit()
 
 #---------------------------------------------------------------------------#
 #   Exposed APIs                                                            #
 #---------------------------------------------------------------------------#
 
 
-def fetch_ranking_info(date="", mode="daily", content="", pages=-1):
+def fetch_ranking_info(
+        date="", mode="daily", content="", pages=-1, *, warehouse=None
+    ):
     """
     Fetch daily(or other period) ranking info.
 
@@ -315,6 +1298,8 @@ def fetch_ranking_info(date="", mode="daily", content="", pages=-1):
             If page == -1, fetches all page, otherwise follows input param.
             For the maximum page available, see "MODE_PAGES".
             Illust per page is 50.
+        warehouse   `warehouse.Warehouse`
+            If given, fetched ranking is stored into it.
 
     Returns:
         dict from deserialized json, contains infos about ranking illusts.
@@ -348,6 +1333,8 @@ def fetch_ranking_info(date="", mode="daily", content="", pages=-1):
         merge_key=lambda x: x["contents"],
         sort_key=lambda x: x["rank"]
     )
+    if warehouse is not None and not jscontent.get("error"):
+        warehouse.ingest(jscontent)
     return jscontent
 
 def fetch_spotlight_info(feature):
@@ -428,7 +1415,8 @@ def fetch_spotlight_list(article_num=17, pages=1):
 def download_spotlight(
         feature,
         *,
-        savedir=DEFAULT_SAVEDIR, dirname=""
+        savedir=DEFAULT_SAVEDIR, dirname="",
+        profile=None, profile_cprofile=False, **options
     ):
     """
     Download spotlight illusts with given feature code.
@@ -440,6 +1428,13 @@ def download_spotlight(
             Directory of illust to place.
         dirname     `str`
             Directory name containing illusts.
+        profile     `str`
+            If given, profile this run and write reports to files prefixed
+            by it, see "_Profiler".
+        profile_cprofile `bool`
+            Run cProfile as well while profiling.
+        options
+            Keyword options of "_Job", such as `hedge`.
     
     Returns:
         list of integer, indicated downloaded bytes.
@@ -450,15 +1445,18 @@ def download_spotlight(
             may result in this error.
     """
     #   Add more options:   savedir, dirname
-    js = fetch_spotlight_info(feature)
-    if js["error"]:
-        raise Exception(js["message"])
-    #   Forging save path.
-    if not dirname:
-        dirname = "Spotlight_{feature}".format(feature=feature)
-    fullpath = os.path.join(savedir, dirname)
-    metadatas = list(map(_make_illust_meta, js["body"][0]["illusts"]))
-    return _download("spotlight", metadatas, fullpath)
+    with _profiling(profile, profile_cprofile):
+        js = fetch_spotlight_info(feature)
+        if js["error"]:
+            raise Exception(js["message"])
+        #   Forging save path.
+        if not dirname:
+            dirname = "Spotlight_{feature}".format(feature=feature)
+        fullpath = os.path.join(savedir, dirname)
+        metadatas = list(map(_make_illust_meta, js["body"][0]["illusts"]))
+        #   Only compact metadata is needed from now on, drop raw json.
+        del js
+        return _download("spotlight", metadatas, fullpath, **options)
 
 def filter_content(contents, rules, mode=any):
     """
@@ -491,7 +1489,9 @@ def filter_content(contents, rules, mode=any):
 def download_ranking(
         date="", mode="daily", content="", pages=-1, targets=[],
         *,
-        savedir=DEFAULT_SAVEDIR, dirname=""
+        top_n=0, ranks=None, predicates=(),
+        savedir=DEFAULT_SAVEDIR, dirname="", warehouse=None,
+        profile=None, profile_cprofile=False, **options
     ):
     """
     Download ranking illusts.
@@ -511,10 +1511,28 @@ def download_ranking(
             list of illust_id, which is an integer.
             Illust_id is a 8-digits natural number that strictly growing up,
             could up to 9-digits in the future.
+            If given, download only these illusts, fetching stops once all
+            of them are found.
+        top_n       `int`
+            If positive, download only the top `top_n` illusts.
+        ranks       `tuple`[`int`]
+            Download only illusts ranked within (first, last), inclusive.
+        predicates  `list`
+            Functions take one ranking content and return boolean value,
+            download only contents satisfy all of them.
         savedir     `str`
             Directory of illust to place.
         dirname     `str`
             Directory name containing illusts.
+        warehouse   `warehouse.Warehouse`
+            If given, fetched ranking is stored into it.
+        profile     `str`
+            If given, profile this run and write reports to files prefixed
+            by it, see "_Profiler".
+        profile_cprofile `bool`
+            Run cProfile as well while profiling.
+        options
+            Keyword options of "_Job", such as `hedge`.
     
     Returns:
         list of integer, indicated downloaded bytes.
@@ -524,33 +1542,577 @@ def download_ranking(
             Too much concurrent connection or dense request 
             may result in this error.
     """
-    js = fetch_ranking_info(date, mode, content, pages)
-    if js["error"]:
-        raise Exception(js["message"])
-    #   Forging save path.
-    if not date:
-        date = js["date"]
+    if date and not _is_valid_date(date):
+        raise ValueError("Invalid date")
+    if top_n > 0:
+        ranks = (1, top_n)
+    with _profiling(profile, profile_cprofile):
+        date, metadatas = _fetch_ranking_metas(
+            date, mode, content, pages,
+            ranks=ranks, targets=targets, predicates=predicates,
+            warehouse=warehouse
+        )
+        #   Forging save path.
+        datestr = datetime.datetime.strptime(date, "%Y%m%d")
+        if not dirname:
+            dirname = datetime.datetime.strftime(datestr, DEFAULT_FILEFMT)
+        fullpath = os.path.join(savedir, dirname)
+        return _download("ranking", metadatas, fullpath, **options)
+
+def set_bandwidth(rate=0, burst=None, schedule=None):
+    """
+    Limit total download rate of every job.
+
+    Args:
+        rate        `int`
+            Bytes per second, 0 for unlimited.
+        burst       `int`
+            Bytes allowed above `rate` in a burst, defaults to
+            "BANDWIDTH_BURST_SECONDS" worth of `rate`.
+        schedule    `list`[`tuple`]
+            (start, end, rate) with start and end in form of "HH:MM" local
+            time, e.g. [("09:00", "18:00", 2 * 1024 ** 2)] limits rate in
+            business hours only.
+
+    Returns:
+        None
+
+    Raises:
+        None
+    """
+    _bandwidth.configure(rate, burst, schedule)
+
+def load_shard_index(dirname):
+    """
+    Load index of archive shards.
+
+    Args:
+        dirname     `str`
+            Directory containing shards, see "download_ranking".
+
+    Returns:
+        dict maps "illust_id_pN" to dict of "shard", "offset" and "size".
+
+    Raises:
+        None
+    """
+    index = dict()
+    if not os.path.isdir(dirname):
+        return index
+    for fname in sorted(filter(_pat_shard_index.match, os.listdir(dirname))):
+        with open(os.path.join(dirname, fname), "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                index[entry["key"]] = entry
+    return index
+
+def read_shard_member(dirname, key, index=None):
+    """
+    Read a file saved in archive shards without unpacking the shard.
+
+    Args:
+        dirname     `str`
+            Directory containing shards.
+        key         `str`
+            File name without extension, in form of "illust_id_pN".
+        index       `dict`
+            Index from "load_shard_index", loaded if not given.
+
+    Returns:
+        `bytes` of the file.
+
+    Raises:
+        KeyError
+            File is not found in index.
+    """
+    if index is None:
+        index = load_shard_index(dirname)
+    return _read_shard_entry(dirname, index[key])
+
+def download_illust(
+        *illust_id,
+        savedir=DEFAULT_SAVEDIR, dirname=DEFAULT_ILLUSTDIR,
+        cookies=None, session_id=None, profile=None, profile_cprofile=False,
+        **options
+    ):
+    """
+    Download illusts by illust_id.
+
+    Metadata of each illust is resolved concurrently through ajax api, which
+    gives the original url and page count, then downloaded in the same
+    pipeline as rankings.
+
+    Args:
+        illust_id   `int`
+            Illust_id to download, any number of them.
+        savedir     `str`
+            Directory of illust to place.
+        dirname     `str`
+            Directory name containing illusts.
+        cookies     `str`
+            File of persistent cookie jar, loaded before and saved after
+            download.
+        session_id  `str`
+            "PHPSESSID" cookie of a logged in session, required by R-18
+            illusts.
+        profile     `str`
+            If given, profile this run, see "download_ranking".
+        profile_cprofile `bool`
+            Run cProfile as well while profiling.
+        options
+            Keyword options of "_Job", such as `hedge`.
+
+    Returns:
+        list of integer, indicated downloaded bytes.
+
+    Raises:
+        aiohttp.ServerDisconnectedError
+            Too much concurrent connection or dense request 
+            may result in this error.
+    """
+    fullpath = os.path.join(savedir, dirname)
+    with _profiling(profile, profile_cprofile):
+        return _loop.run_until_complete(
+            _download_by_id(illust_id, fullpath, cookies, session_id, options)
+        )
+
+async def _download_by_id(illust_ids, fullpath, cookies, session_id, options):
+    jar = _make_cookie_jar(cookies, session_id)
+    try:
+        async with _open_client(cookie_jar=jar) as client:
+            downloaded = await _run_job(
+                "illust", illust_ids, fullpath, client=client, **options
+            )
+    finally:
+        if cookies:
+            jar.save(cookies)
+    return downloaded
+
+def _make_cookie_jar(cookies=None, session_id=None):
+    """ Cookie jar loaded from file `cookies`, with optional "PHPSESSID". """
+    jar = aiohttp.CookieJar(loop=_loop)
+    if cookies and os.path.exists(cookies):
+        jar.load(cookies)
+    if session_id:
+        jar.update_cookies({"PHPSESSID": session_id}, URL(PIXIV_URL))
+    return jar
+
+def plan_ranking(
+        date="", mode="daily", content="", pages=-1, targets=[],
+        *,
+        top_n=0, ranks=None, predicates=(),
+        savedir=DEFAULT_SAVEDIR, dirname="", archive=None, warehouse=None
+    ):
+    """
+    Plan ranking download without downloading anything.
+
+    Ranking is fetched and file exts are resolved as "download_ranking"
+    does, then size of every page is taken from HEAD. Arguments are the same
+    as "download_ranking".
+
+    Returns:
+        `dict` of plan, serializable to JSON, see "_plan_job". Pass it to
+        "download_plan" to download exactly what is planned.
+
+    Raises:
+        aiohttp.ServerDisconnectedError
+            Too much concurrent connection or dense request 
+            may result in this error.
+    """
+    if date and not _is_valid_date(date):
+        raise ValueError("Invalid date")
+    if top_n > 0:
+        ranks = (1, top_n)
+    date, metadatas = _fetch_ranking_metas(
+        date, mode, content, pages,
+        ranks=ranks, targets=targets, predicates=predicates,
+        warehouse=warehouse
+    )
     datestr = datetime.datetime.strptime(date, "%Y%m%d")
     if not dirname:
         dirname = datetime.datetime.strftime(datestr, DEFAULT_FILEFMT)
     fullpath = os.path.join(savedir, dirname)
-    #   Filtering by given name.
-    ok = _filter_by_name(js["contents"], targets)
-    metadatas = list(map(_make_illust_meta, ok))
-    return _download("ranking", metadatas, fullpath)
+    return _loop.run_until_complete(
+        _plan_job("ranking", metadatas, savedir, fullpath, archive)
+    )
 
-def download_illust(
-        *illust_id,
-        savedir=DEFAULT_SAVEDIR, dirname=""
+def plan_spotlight(
+        feature, *, savedir=DEFAULT_SAVEDIR, dirname="", archive=None
+    ):
+    """
+    Plan spotlight download without downloading anything, see
+    "plan_ranking" and "download_spotlight".
+    """
+    js = fetch_spotlight_info(feature)
+    if js["error"]:
+        raise Exception(js["message"])
+    if not dirname:
+        dirname = "Spotlight_{feature}".format(feature=feature)
+    fullpath = os.path.join(savedir, dirname)
+    metadatas = list(map(_make_illust_meta, js["body"][0]["illusts"]))
+    del js
+    return _loop.run_until_complete(
+        _plan_job("spotlight", metadatas, savedir, fullpath, archive)
+    )
+
+def download_plan(plan, **options):
+    """
+    Download a plan of "plan_ranking" or "plan_spotlight".
+
+    Illusts are downloaded as resolved in the plan, no metadata is fetched
+    again. Illusts already saved are skipped unless `skip_existing` is
+    False.
+
+    Args:
+        plan        `dict` or `str`
+            Plan, or path of a JSON file it is dumped to.
+        options
+            Keyword options of "_Job", such as `hedge`.
+
+    Returns:
+        list of integer, indicated downloaded bytes.
+
+    Raises:
+        aiohttp.ServerDisconnectedError
+            Too much concurrent connection or dense request 
+            may result in this error.
+    """
+    if isinstance(plan, str):
+        with open(plan, "r", encoding="utf-8") as f:
+            plan = json.load(f)
+    resolveds = [
+        NewIllustResolved(
+            NewIllustMeta(
+                i["illust_id"], i["illust_page_count"], i["template_url"],
+                IllustType(i["illust_type"])
+            ),
+            i["ext"]
+        )
+        for i in plan["illusts"]
+    ]
+    options.setdefault("skip_existing", True)
+    options.setdefault("archive", plan["archive"])
+    start = time.perf_counter()
+    downloaded = _download(plan["task"], resolveds, plan["dirname"], **options)
+    #   Only a downloaded plan is timed, for the ETA of later plans.
+    savedir = plan.get("savedir") or os.path.dirname(plan["dirname"])
+    _record_throughput(savedir, sum(downloaded), time.perf_counter() - start)
+    return downloaded
+
+def watch(
+        targets=(("daily", ""),),
+        *,
+        spotlight=True, savedir=DEFAULT_SAVEDIR, state=DEFAULT_WATCH_STATE,
+        interval=0, cycles=-1, warehouse=None,
+        profile=None, profile_cprofile=False, **options
+    ):
+    """
+    Keep a local mirror of rankings and spotlights up to date.
+
+    Every cycle checks the most recent ranking of each target and the latest
+    spotlights, and only downloads what is newer than the watermark in
+    `state`, skipping illusts already saved. One connection pool is kept
+    across cycles.
+
+    Args:
+        targets     `list`[`tuple`]
+            Pairs of (mode, content), see "AVAILABLE_MODES" and
+            "AVAILABLE_CONTENTS".
+        spotlight   `bool`
+            Watch newly published spotlights as well.
+        savedir     `str`
+            Directory of illust to place.
+        state       `str`
+            JSON file keeping watermarks between runs.
+        interval    `int`
+            Seconds between cycles, if 0, wait for next ranking publish
+            time, see "WATCH_PUBLISH_TIME".
+        cycles      `int`
+            Number of cycles to run, -1 for running forever.
+        warehouse   `warehouse.Warehouse`
+            If given, fetched rankings are stored into it.
+        profile     `str`
+            If given, profile this run, see "download_ranking". Reports are
+            written once watching ends.
+        profile_cprofile `bool`
+            Run cProfile as well while profiling.
+        options
+            Keyword options of "_Job", such as `hedge`.
+
+    Returns:
+        None
+
+    Raises:
+        Any type of connection error.
+    """
+    with _profiling(profile, profile_cprofile):
+        _loop.run_until_complete(
+            _watch(
+                targets, spotlight, savedir, state, interval, cycles,
+                warehouse, options
+            )
+        )
+
+async def _watch(
+        targets, spotlight, savedir, state, interval, cycles,
+        warehouse, options
+    ):
+    marks = dict()
+    if os.path.exists(state):
+        with open(state, "r", encoding="utf-8") as f:
+            marks = json.load(f)
+    async with _open_client() as client:
+        n = 0
+        while cycles < 0 or n < cycles:
+            n += 1
+            pxlog.info("Watch cycle %d", n)
+            behind = False
+            for mode, content in targets:
+                behind |= await _watch_ranking(
+                    client, mode, content, marks, savedir, warehouse, options
+                )
+                _save_watch_state(state, marks)
+            if spotlight:
+                await _watch_spotlight(client, marks, savedir, options)
+                _save_watch_state(state, marks)
+            if not (cycles < 0 or n < cycles):
+                break
+            if interval:
+                delay = interval
+            elif behind:
+                delay = WATCH_RETRY_DELAY
+            else:
+                delay = _next_publish_delay()
+            pxlog.info("Next watch cycle in %.0f s", delay)
+            await asyncio.sleep(delay, loop=_loop)
+
+async def _watch_ranking(
+        client, mode, content, marks, savedir, warehouse, options
     ):
-    #   
-    #   This function requires login, there should be a better place rather
-    #   than raw expose.
-    #   Make query -> tear_down -> call async download
-    #   Async query? -> cookie persistency?
-    raise NotImplementedError
+    """ Download rankings newer than watermark, returns True if the
+    expected most recent ranking is not published yet. """
+    key = f"{mode}:{content}"
+    #   One request for the date of most recent ranking, the rest of it is
+    #   fetched only if it is newer than watermark.
+    texts = await _query_dispatcher(
+        RANKING_URL, _make_query("", mode, content, 1),
+        headers=CAMOUFLAGE_HEADERS, client=client
+    )
+    first = json.loads(texts[0])
+    del texts
+    if first.get("error"):
+        pxlog.info("Ranking %s unavailable: %s", key, first.get("message"))
+        return True
+    latest = first["date"]
+    mark = marks.get(key)
+    if mark and mark >= latest:
+        return latest < _expected_ranking_date()
+    dates = []
+    if mark:
+        dates = list(
+            _iter_dates(_shift_date(mark, 1), _shift_date(latest, -1))
+        )
+    options = dict(options, skip_existing=True)
+    for date in dates + [latest]:
+        if date == latest:
+            metadatas = await _watch_latest(
+                client, first, mode, content, warehouse
+            )
+        else:
+            fetched = await _watch_fetch(
+                client, date, mode, content, None, warehouse
+            )
+            if fetched is None:
+                continue
+            _, metadatas = fetched
+        dirname = datetime.datetime.strptime(date, "%Y%m%d").strftime(
+            DEFAULT_FILEFMT
+        )
+        await _run_job(
+            f"ranking.{mode}", metadatas, os.path.join(savedir, dirname),
+            client=client, **options
+        )
+        marks[key] = date
+    return latest < _expected_ranking_date()
+
+async def _watch_latest(client, first, mode, content, warehouse):
+    """ Metadata of most recent ranking, page 1 of it is `first`. """
+    if warehouse is not None:
+        await _ingest(warehouse, first)
+    metadatas = list(map(_make_illust_meta, first["contents"]))
+    if not first.get("next"):
+        return metadatas
+    last = len(_make_query(first["date"], mode, content)) * RANKING_PAGE_SIZE
+    fetched = await _watch_fetch(
+        client, first["date"], mode, content,
+        (RANKING_PAGE_SIZE + 1, last), warehouse
+    )
+    if fetched is not None:
+        metadatas.extend(fetched[1])
+    return metadatas
+
+async def _watch_fetch(client, date, mode, content, ranks, warehouse):
+    """ Date and metadata of a ranking, None if it is unavailable. """
+    try:
+        return await _query_ranking_metas(
+            client, date, mode, content, -1, ranks, (), (), warehouse
+        )
+    except aiohttp.ClientError:
+        raise
+    except Exception as err:
+        pxlog.info(
+            "Ranking %s:%s %s unavailable: %s",
+            mode, content, date or "latest", err
+        )
+        return None
 
-def _download(taskname, metadatas, fullpath):
+async def _watch_spotlight(client, marks, savedir, options):
+    texts = await _query_dispatcher(
+        SPOTLIGHT_QUERYLIST_URL, [{"page": 1, "article_num": 17}],
+        headers=SPOTLIGHT_LIST_HEADERS, client=client
+    )
+    articles = json.loads(texts[0]).get("body", [])
+    ids = sorted(int(a["id"]) for a in articles)
+    if not ids:
+        return
+    mark = marks.get("spotlight")
+    #   On first run, only the most recent one is taken.
+    new_ids = [i for i in ids if i > mark] if mark else ids[-1:]
+    for feature in new_ids:
+        texts = await _query_dispatcher(
+            SPOTLIGHT_MAIN_URL, [{"article_id": feature}],
+            headers=CAMOUFLAGE_HEADERS, client=client
+        )
+        js = json.loads(texts[0])
+        if js["error"]:
+            pxlog.info("Spotlight %d unavailable", feature)
+            continue
+        metadatas = list(map(_make_illust_meta, js["body"][0]["illusts"]))
+        del js, texts
+        await _run_job(
+            "spotlight", metadatas,
+            os.path.join(savedir, f"Spotlight_{feature}"),
+            client=client, **dict(options, skip_existing=True)
+        )
+        marks["spotlight"] = feature
+
+def _save_watch_state(state, marks):
+    tmpname = state + ".tmp"
+    with open(tmpname, "w", encoding="utf-8") as f:
+        json.dump(marks, f)
+    os.replace(tmpname, state)
+
+def _expected_ranking_date():
+    """ Ranking of yesterday in Tokyo is expected after publish time. """
+    tokyo_now = datetime.datetime.now(pytz.timezone("Asia/Tokyo"))
+    published = (tokyo_now.hour, tokyo_now.minute) >= WATCH_PUBLISH_TIME
+    date = tokyo_now - datetime.timedelta(days=1 if published else 2)
+    return date.strftime("%Y%m%d")
+
+def _next_publish_delay():
+    """ Seconds until next ranking publish time. """
+    tokyo_now = datetime.datetime.now(pytz.timezone("Asia/Tokyo"))
+    hour, minute = WATCH_PUBLISH_TIME
+    publish = tokyo_now.replace(
+        hour=hour, minute=minute, second=0, microsecond=0
+    )
+    if publish <= tokyo_now:
+        publish += datetime.timedelta(days=1)
+    return (publish - tokyo_now).total_seconds()
+
+def _fetch_ranking_metas(
+        date="", mode="daily", content="", pages=-1, *,
+        ranks=None, targets=(), predicates=(), warehouse=None
+    ):
+    """
+    Fetch ranking pages only as needed and make metadata on the fly.
+
+    Pages outside `ranks` are never requested. If `targets` is given, pages
+    are fetched one by one until every target is found. Contents are
+    filtered as each page arrives, only metadata of selected ones is kept.
+
+    Returns:
+        tuple of (date, list of `IllustMeta`).
+
+    Raises:
+        Exception
+            The first fetched page reports an error.
+    """
+    return _loop.run_until_complete(
+        _query_ranking_metas(
+            None, date, mode, content, pages,
+            ranks, targets, predicates, warehouse
+        )
+    )
+
+#   SQLite blocks, warehouse is written from this thread, one at a time.
+_warehouse_executor = ThreadPoolExecutor(1)
+
+async def _ingest(warehouse, js):
+    """ Store ranking `js` into `warehouse` off the event loop. """
+    return await _loop.run_in_executor(
+        _warehouse_executor, warehouse.ingest, js
+    )
+
+@_staged
+async def _query_ranking_metas(
+        client, date, mode, content, pages,
+        ranks, targets, predicates, warehouse
+    ):
+    """ Coroutine of "_fetch_ranking_metas". """
+    queries = _make_query(date, mode, content, pages)
+    first, last = ranks or (1, len(queries) * RANKING_PAGE_SIZE)
+    queries = queries[
+        (first - 1) // RANKING_PAGE_SIZE:math.ceil(last / RANKING_PAGE_SIZE)
+    ]
+    if not queries:
+        raise ValueError(f"Ranks out of range: {first}-{last}")
+    wanted = set(targets)
+    #   Pages are fetched one at a time if it may stop early.
+    batch = 1 if wanted else max(1, len(queries))
+    metadatas = []
+    fetched = 0
+    pxlog.info("Start fetching ranking %s info", date or "latest")
+    for i in range(0, len(queries), batch):
+        texts = await _query_dispatcher(
+            RANKING_URL, queries[i:i + batch],
+            headers=CAMOUFLAGE_HEADERS, client=client
+        )
+        for text in texts:
+            js = json.loads(text)
+            if js.get("error"):
+                if not fetched:
+                    raise Exception(js["message"])
+                #   Out of available pages.
+                wanted.clear()
+                break
+            fetched += 1
+            date = js["date"]
+            if warehouse is not None:
+                await _ingest(warehouse, js)
+            for c in js["contents"]:
+                if not (first <= c["rank"] <= last):
+                    continue
+                if targets and not (c["illust_id"] in wanted):
+                    continue
+                if not all(p(c) for p in predicates):
+                    continue
+                wanted.discard(c["illust_id"])
+                metadatas.append(_make_illust_meta(c))
+            if not js.get("next"):
+                wanted.clear()
+                break
+        if targets and not wanted:
+            break
+    pxlog.info(
+        "Fetched %d ranking pages, %d illusts selected",
+        fetched, len(metadatas)
+    )
+    return date, metadatas
+
+def _download(taskname, metadatas, fullpath, **options):
     """
     Core function for launching concurrent tasks.
     
@@ -562,6 +2124,8 @@ def _download(taskname, metadatas, fullpath):
             Should only generated by '_make_illust_meta'.
         fullpath    string
             Path of a directory, saving downloaded images.
+        options
+            Keyword options of "_Job".
     
     Returns:
         list of integer, indicates bytes downloaded.
@@ -571,24 +2135,181 @@ def _download(taskname, metadatas, fullpath):
             Too much concurrent connection or dense request 
             may result in this error.
     """
+    return _loop.run_until_complete(
+        _run_job(taskname, metadatas, fullpath, **options)
+    )
+
+async def _run_job(taskname, metadatas, fullpath, *, client=None, **options):
+    """ Coroutine of "_download", optionally with a shared `client`. """
     start = time.perf_counter()
-    pxlog.info("Start download illusts")
+    job = _Job(fullpath, name=taskname, **options)
+    job.log.info("Start download illusts")
 
-    downloaded = _loop.run_until_complete(
-        _chaining(metadatas, fullpath)
-    )
+    try:
+        downloaded = await _chaining(metadatas, job, client)
 
-    pxlog.info(f"Download {taskname} ok")
-    elapsed = time.perf_counter() - start
-    total_size = sum(downloaded)
-    avg_speed = total_size / elapsed
-    pxlog.info(
-        f"Elapsed time: {elapsed:.2f} s, avg: {byte2human(avg_speed)}/s"
+        job.log.info(f"Download {taskname} ok")
+        elapsed = time.perf_counter() - start
+        total_size = sum(downloaded)
+        avg_speed = total_size / elapsed
+        job.log.info(
+            f"Elapsed time: {elapsed:.2f} s, avg: {byte2human(avg_speed)}/s"
+        )
+        job.log.info(
+            f"Total {len(downloaded)} illusts, {byte2human(total_size)}"
+        )
+    finally:
+        job.close()
+    return downloaded
+
+async def _plan_job(
+        taskname, metadatas, savedir, fullpath, archive=None, client=None
+    ):
+    """
+    Resolve illusts and sizes of pages, nothing is written.
+
+    Returns:
+        `dict` with keys
+            task, savedir, dirname, archive
+                        Arguments of this job.
+            illusts     list of dict, fields of `IllustMeta`, "ext" and
+                        "sizes" of pages, illusts already saved are left
+                        out.
+            unresolved  list of illust_id whose file ext is not found.
+            pages       Number of pages.
+            requests    Number of download requests, including segments.
+            skipped     Number of pages already saved.
+            bytes       Expected bytes, pages of unknown size excluded.
+            unknown     Number of pages of unknown size.
+            hosts       dict maps host to expected bytes.
+            eta         Expected seconds, None if no throughput is known.
+    """
+    if client is None:
+        async with _open_client() as client:
+            return await _plan_job(
+                taskname, metadatas, savedir, fullpath, archive, client
+            )
+    log = pxlog.getChild(taskname)
+    log.info("Start planning %s", fullpath)
+    held = _HeldIndex(fullpath, archive)
+    header = {"referer": RANKING_REFERER}
+
+    async def head(url):
+        async with _sem:
+            async with client.head(url, headers=header) as resp:
+                if resp.status != HTTPStatus.OK:
+                    return None
+                return resp.content_length
+
+    async def probe(metadata):
+        if _is_held(held, metadata):
+            return metadata, None, True, []
+        async with _sem:
+            resolved, size = await _ext_head(client, metadata, log)
+        if resolved is None:
+            return metadata, None, False, []
+        #   Size of page 0 comes with its file ext if it was probed.
+        sizes = [] if size is None else [size]
+        sizes += await asyncio.gather(
+            *(
+                head(_make_derived(metadata, resolved.ext, i).url)
+                for i in range(len(sizes), metadata.illust_page_count)
+            ),
+            loop=_loop
+        )
+        return metadata, resolved.ext, False, sizes
+
+    plan = {
+        "task": taskname, "savedir": savedir, "dirname": fullpath,
+        "archive": archive,
+        "illusts": [], "unresolved": [],
+        "pages": 0, "requests": 0, "skipped": 0, "bytes": 0, "unknown": 0,
+        "hosts": dict(), "eta": None
+    }
+    hosts = defaultdict(int)
+    for metadata, ext, is_held, sizes in await _pool_map(probe, metadatas):
+        plan["pages"] += metadata.illust_page_count
+        if is_held:
+            plan["skipped"] += metadata.illust_page_count
+            continue
+        if ext is None:
+            plan["unresolved"].append(metadata.illust_id)
+            continue
+        plan["illusts"].append(dict(metadata._asdict(), ext=ext, sizes=sizes))
+        host = urllib.parse.urlsplit(metadata.template_url).netloc
+        for size in sizes:
+            if size is None:
+                plan["unknown"] += 1
+                plan["requests"] += 1
+                continue
+            plan["bytes"] += size
+            hosts[host] += size
+            plan["requests"] += (
+                SEGMENT_COUNT if size > SEGMENT_THRESHOLD else 1
+            )
+    plan["hosts"] = dict(hosts)
+    rate = _recent_throughput(savedir)
+    if _bandwidth.rate:
+        rate = min(rate or _bandwidth.rate, _bandwidth.rate)
+    if rate:
+        plan["eta"] = plan["bytes"] / rate
+    _log_plan(plan, log)
+    return plan
+
+def _log_plan(plan, log=pxlog):
+    log.info(
+        "%d illusts, %d pages, %d requests, %d pages already saved",
+        len(plan["illusts"]), plan["pages"], plan["requests"],
+        plan["skipped"]
     )
-    pxlog.info(
-        f"Total {len(downloaded)} illusts, {byte2human(total_size)}"
+    for host, size in sorted(plan["hosts"].items()):
+        log.info("%s: %s", host, byte2human(size))
+    eta = "unknown" if plan["eta"] is None else f"{plan['eta']:.0f} s"
+    log.info(
+        "Expected %s, %d pages of unknown size, ETA %s",
+        byte2human(plan["bytes"]), plan["unknown"], eta
     )
-    return downloaded
+    if plan["unresolved"]:
+        log.info("%d illusts not resolved", len(plan["unresolved"]))
+
+
+class _HeldIndex:
+    """ Read-only view of files saved in an output directory. """
+    def __init__(self, dirname, archive=None):
+        self.dirname = dirname
+        self._keys = None
+        if archive:
+            self._keys = set(load_shard_index(dirname))
+
+    def exists(self, name):
+        if self._keys is not None:
+            return _shard_key(name) in self._keys
+        return os.path.exists(os.path.join(self.dirname, name))
+
+
+def _record_throughput(savedir, size, elapsed):
+    """ Keep throughput of a downloaded plan for estimating plans. """
+    if not size or elapsed <= 0:
+        return
+    samples = _load_throughput(savedir)
+    samples.append([time.time(), size / elapsed])
+    fname = os.path.join(savedir, THROUGHPUT_HISTORY)
+    tmpname = fname + ".tmp"
+    with open(tmpname, "w", encoding="utf-8") as f:
+        json.dump(samples[-THROUGHPUT_SAMPLES:], f)
+    os.replace(tmpname, fname)
+
+def _load_throughput(savedir):
+    fname = os.path.join(savedir, THROUGHPUT_HISTORY)
+    if not os.path.exists(fname):
+        return []
+    with open(fname, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def _recent_throughput(savedir):
+    """ Median of recent throughput in bytes/s, 0 if unknown. """
+    rates = sorted(rate for _, rate in _load_throughput(savedir))
+    return rates[len(rates) // 2] if rates else 0
 
 
 #---------------------------------------------------------------------------#
@@ -597,168 +2318,650 @@ def _download(taskname, metadatas, fullpath):
 
 
 async def _query_dispatcher(
-        url, queries, *, headers=dict()
+        url, queries, *, headers=dict(), client=None
     ):
     """ Launching concurrent queries with given headers. """
     #   if page is out of range, received article will less than article_num.
-    _tcpconn = aiohttp.TCPConnector(limit=SEM_LIMIT, loop=_loop)
+    if client is None:
+        async with _open_client(headers) as client:
+            return await _query_dispatcher(url, queries, client=client)
     texts = []
-    async with aiohttp.ClientSession(
-            loop=_loop, headers=headers, connector=_tcpconn
-        ) as client:
-        try:
-            tasks = [
-                _query_fetcher(client, url, q)
-                for q in queries
-            ]
-            gat = asyncio.gather(*tasks, loop=_loop)
-            texts = await gat
-        except Exception:
-            gat.cancel()
-            raise
+    try:
+        tasks = [
+            _query_fetcher(client, url, q, headers)
+            for q in queries
+        ]
+        gat = asyncio.gather(*tasks, loop=_loop)
+        texts = await gat
+    except Exception:
+        gat.cancel()
+        raise
     return texts
 
-async def _query_fetcher(client, url, query):
+@_staged
+async def _query_fetcher(client, url, query, headers=None):
     async with _sem:
         # await asyncio.sleep(random.random() * 0.7 + 0.3, loop=_loop)
-        async with client.get(url, params=query) as resp:
+        async with client.get(url, params=query, headers=headers) as resp:
             text = await resp.text()
     return text
 
-async def _chaining(metadatas, dirname):
-    _tcpconn = aiohttp.TCPConnector(limit=SEM_LIMIT, loop=_loop)
-    if not os.path.exists(dirname):
-        os.makedirs(dirname)
-    # This layer intends to reuse session, but does it really works?
-    async with aiohttp.ClientSession(
-            loop=_loop, headers=CAMOUFLAGE_HEADERS, connector=_tcpconn
-        ) as client:
-        # Not using raise for status, status is necessary in judging
-        # file extensions.
-        approved = await _ext_dispatcher(client, metadatas)
-        downloaded = await _dl_dispatcher(client, approved, dirname)
-    return downloaded
+async def _pool_map(func, source, *, workers=SEM_LIMIT, collect=True):
+    """ Run `func` over items of `source` with a fixed number of workers.
 
-async def _ext_dispatcher(client, metadatas):
-    pxlog.info("Start trying file exts")
-    tasks = [
-        _loop.create_task(_ext_fetcher(client, m))
-        for m in metadatas
-    ]
+    `source` can be an iterable or an async iterable, it is consumed lazily
+    and at most "QUEUE_LIMIT" items are pulled ahead of the workers.
+    Results are returned in completion order if `collect` is set.
+    """
+    queue = asyncio.Queue(QUEUE_LIMIT, loop=_loop)
+    results = []
+
+    async def feed():
+        if hasattr(source, "__aiter__"):
+            async for item in source:
+                await queue.put(item)
+        else:
+            for item in source:
+                await queue.put(item)
+        for _ in range(workers):
+            await queue.put(_STOP)
+
+    async def work():
+        while True:
+            item = await queue.get()
+            if item is _STOP:
+                break
+            res = await func(item)
+            if collect:
+                results.append(res)
+
+    tasks = [_loop.create_task(feed())]
+    tasks.extend(_loop.create_task(work()) for _ in range(workers))
     gat = asyncio.gather(*tasks, loop=_loop)
     try:
-        res = await gat
+        await gat
+    except:
+        # Cancel once error occurs, purge pending workers.
+        gat.cancel()
+        raise
+    return results
+
+async def _drain(queue):
+    """ Iterate over `queue` until "_STOP" is received. """
+    while True:
+        item = await queue.get()
+        if item is _STOP:
+            break
+        yield item
+
+def _open_client(headers=CAMOUFLAGE_HEADERS, cookie_jar=None):
+    _tcpconn = aiohttp.TCPConnector(limit=CONN_LIMIT, loop=_loop)
+    return aiohttp.ClientSession(
+        loop=_loop, headers=headers, connector=_tcpconn,
+        cookie_jar=cookie_jar
+    )
+
+async def _chaining(metadatas, job, client=None):
+    if client is None:
+        # This layer intends to reuse session, but does it really works?
+        async with _open_client() as client:
+            return await _chaining(metadatas, job, client)
+    if job.skip_existing:
+        metadatas = _skip_held(metadatas, job)
+    # Not using raise for status, status is necessary in judging
+    # file extensions.
+    # Both stages run at the same time, pages flow through a bounded
+    # queue so resolving waits for downloading once it runs ahead.
+    pages = asyncio.Queue(QUEUE_LIMIT, loop=_loop)
+    gat = asyncio.gather(
+        _ext_dispatcher(client, metadatas, pages, job),
+        _dl_dispatcher(client, _drain(pages), job),
+        loop=_loop
+    )
+    try:
+        _, downloaded = await gat
     except:
-        # Cancel once error occurs, purge pending tasks.
         gat.cancel()
         raise
-    # Unwind nested list.
-    res = [i for each in res for i in each]
-    pxlog.debug("Tried {} files".format(len(res)))
+    finally:
+        if job.post is not None:
+            await job.post.join(job.log)
+    return downloaded
+
+def _skip_held(metadatas, job):
+    """ Drop illusts already saved in job output. """
+    skipped = 0
+    for m in metadatas:
+        if isinstance(m, NewIllustResolved) and _is_held(job.output, m.meta):
+            skipped += 1
+            continue
+        if isinstance(m, NewIllustMeta) and _is_held(job.output, m):
+            skipped += 1
+            continue
+        yield m
+    job.log.info("Skipped %d illusts already saved", skipped)
+
+def _iter_held(output, illust_id):
+    """ Names of pages of illust saved in `output`, in page order. """
+    for page in itertools.count():
+        names = [
+            f"{illust_id}_p{page}.{ext}" for ext in COMMON_EXTS
+            if output.exists(f"{illust_id}_p{page}.{ext}")
+        ]
+        if not names:
+            break
+        yield from names
+
+def _illust_key(item):
+    """ illust_id of an item taken by "_ext_dispatcher". """
+    if isinstance(item, NewIllustResolved):
+        item = item.meta
+    if isinstance(item, NewIllustMeta):
+        item = item.illust_id
+    return int(item)
+
+def _is_held(output, meta):
+    """ Check if the last page of illust is saved in `output`. """
+    last = "{}_p{}".format(meta.illust_id, meta.illust_page_count - 1)
+    return any(output.exists(f"{last}.{ext}") for ext in COMMON_EXTS)
+
+async def _ext_dispatcher(client, metadatas, pages, job):
+    """ Resolve file exts and put pages into `pages` queue.
+
+    Items of `metadatas` are `IllustMeta` probed for file ext,
+    `IllustResolved` taken as is, or illust_id resolved through ajax api.
+    """
+    job.log.info("Start trying file exts")
+    tried = 0
+
+    async def resolve(metadata):
+        nonlocal tried
+        if isinstance(metadata, NewIllustResolved):
+            res = metadata
+        elif isinstance(metadata, NewIllustMeta):
+            res = await _ext_fetcher(client, metadata, job.log)
+        else:
+            res = await _ajax_fetcher(client, metadata, job.log)
+        tried += 1
+        #   Drop illusts without extension found.
+        if res is None:
+            return
+        for item in _iter_pages((res,)):
+            await pages.put(item)
+
+    await _pool_map(resolve, metadatas, collect=False)
+    await pages.put(_STOP)
+    job.log.debug("Tried %d illusts", tried)
+
+async def _ext_fetcher(client, metadata, log=pxlog):
+    res, _ = await _ext_flights.do(
+        metadata.template_url, _ext_locked, client, metadata, log
+    )
     return res
 
-async def _ext_fetcher(client, metadata):
+async def _ext_locked(client, metadata, log):
     async with _sem:
-        res = await _ext_core(client, metadata)
+        res = await _ext_core(client, metadata, log)
+    return res
+
+@_staged
+async def _ext_core(client, metadata, log=pxlog):
+    #   If a file ext is not found, return None.
+    res, _ = await _ext_head(client, metadata, log)
     return res
 
-async def _ext_core(client, metadata):
-    #   If a file ext is not found, return enpty list.
+async def _ext_head(client, metadata, log=pxlog):
+    """ Resolve file ext, returns (resolved, size of page 0), size is None
+    if not known. Resolved is None if no file ext is found. """
     header = {"referer": RANKING_REFERER}
-    pxlog.debug("Trying {}".format(metadata.illust_id))
+    log.debug("Trying %s", metadata.illust_id)
     #   The file ext of type UGOIRA is determined.
     if metadata.illust_type == IllustType.UGOIRA:
-        return _make_derived_fields(metadata, 'zip')
+        return NewIllustResolved(metadata, "zip"), None
     for ext in COMMON_EXTS:
         # await asyncio.sleep(random.random()*2 + 0.3, loop=_loop)
         sample_url = _make_sample_url(metadata, ext)
         async with client.head(sample_url, headers=header) as resp:
             status = resp.status
             if status == HTTPStatus.OK:
-                pxlog.debug("{} -> {}".format(metadata.illust_id, ext))
-                return _make_derived_fields(metadata, ext)
+                log.debug("%s -> %s", metadata.illust_id, ext)
+                return NewIllustResolved(metadata, ext), resp.content_length
             elif status == HTTPStatus.NOT_FOUND:
                 continue
             else:
-                pxlog.debug(
-                    "Status of {}: {}".format(metadata.illust_id, status)
-                )
+                log.debug("Status of %s: %s", metadata.illust_id, status)
             pass
         pass
     #   Prompt for not found.
-    #   Return empty list for not hit.
-    pxlog.info("{} extension not found".format(metadata.illust_id))
-    return []
-
-async def _dl_dispatcher(client, deriveds, dirname):
-    pxlog.debug("Dispatching download tasks: {}".format(len(deriveds)))
-    tasks = [
-        _loop.create_task(_dl_fetcher(client, drv, dirname))
-        for drv in deriveds
-    ]
-    gat = asyncio.gather(*tasks, loop=_loop)
-    try:
-        res = await gat
-    except:
-        gat.cancel()
-        raise
+    #   Return None for not hit.
+    log.info("%s extension not found", metadata.illust_id)
+    return None, None
+
+async def _ajax_fetcher(client, illust_id, log=pxlog):
+    res, _ = await _ext_flights.do(
+        ILLUST_AJAX_template.format(illust_id),
+        _ajax_locked, client, illust_id, log
+    )
     return res
 
-async def _dl_fetcher(client, derived, dirname):
+async def _ajax_locked(client, illust_id, log):
+    async with _sem:
+        res = await _ajax_core(client, illust_id, log)
+    return res
+
+@_staged
+async def _ajax_core(client, illust_id, log=pxlog):
+    """ Resolve illust by illust_id, returns None if not available. """
+    header = {"referer": RANKING_REFERER + str(illust_id)}
+    log.debug("Querying %s", illust_id)
+    js = await _ajax_json(
+        client, ILLUST_AJAX_template.format(illust_id), header, log
+    )
+    if js is None or js["error"]:
+        log.info("Illust %s unavailable", illust_id)
+        return None
+    body = js["body"]
+    illust_type = IllustType(str(body["illustType"]))
+    if illust_type == IllustType.UGOIRA:
+        js = await _ajax_json(
+            client, UGOIRA_META_template.format(illust_id), header, log
+        )
+        if js is None or js["error"]:
+            log.info("Ugoira %s unavailable", illust_id)
+            return None
+        origin_url = js["body"]["originalSrc"]
+        pages = 1
+    else:
+        origin_url = body["urls"]["original"]
+        pages = int(body["pageCount"])
+    if not origin_url:
+        #   Original url is hidden if login is required.
+        log.info("Illust %s requires login", illust_id)
+        return None
+    return _tear_down_resolved(origin_url, pages, illust_type)
+
+async def _ajax_json(client, url, headers, log=pxlog):
+    """ Fetch json of `url`, returns None on any error status.
+
+    A refused or failed ID is logged and skipped, the rest of a bulk job
+    goes on.
+    """
+    async with client.get(url, headers=headers) as resp:
+        if resp.status != HTTPStatus.OK:
+            if resp.status != HTTPStatus.NOT_FOUND:
+                log.warning("Status of %s: %s", url, resp.status)
+            return None
+        try:
+            return await resp.json()
+        except (aiohttp.ContentTypeError, ValueError) as err:
+            #   E.g. a login or captcha page served with 200.
+            log.warning("Not json from %s: %s", url, err)
+            return None
+
+async def _dl_dispatcher(client, pages, job):
+    """ Download (resolved, page) pairs from `pages`. """
+    job.log.debug("Dispatching download tasks")
+
+    async def fetch(item):
+        resolved, page = item
+        return await _dl_fetcher(client, resolved, page, job)
+
+    return await _pool_map(fetch, pages)
+
+async def _dl_fetcher(client, resolved, page, job):
+    #   Url is forged only when the page is about to be fetched.
+    derived = _make_derived(resolved.meta, resolved.ext, page)
+    (size, output), shared = await _dl_flights.do(
+        derived.url, _dl_locked, client, derived, job
+    )
+    if not shared:
+        if job.post is not None:
+            #   Connection is released, hooks may wait for a slot now.
+            await job.post.flush(job.log)
+        return size
+    #   Downloaded by another job, place a copy in this job's output.
+    if size and output is not job.output:
+        fname = _make_fname(derived)
+        job.output.share(output, fname)
+        await _post_placed(job, fname)
+    job.log.debug("Shared %s", derived.illust_id)
+    return 0
+
+async def _post_placed(job, name):
+    """ Run hooks of `job` on file `name` placed without downloading. """
+    if job.post is None:
+        return
+    path = job.output.path(name)
+    size = 0 if path is None else os.path.getsize(path)
+    data = None
+    if job.post.wants_data(path, size):
+        with job.output.open(name) as f:
+            data = f.read()
+    await job.post.submit(name, path, data, job.log)
+
+async def _dl_locked(client, derived, job):
     #   Simple layer to save indent.
     async with _sem:
         # await asyncio.sleep(random.random()*2 + 0.3)
-        res = await _dl_core(client, derived, dirname)
-    return res
+        res = await _dl_core(client, derived, job)
+    return res, job.output
 
-async def _dl_core(client, derived, dirname):
-    pxlog.debug("Start download {}".format(derived.illust_id))
+@_staged
+async def _dl_core(client, derived, job):
+    job.log.debug("Start download %s", derived.illust_id)
     start = time.perf_counter()
     elapsed = 0
     size = 0
     header = {"referer": RANKING_REFERER}
 
     target_url = derived.url
-    fname = derived.illust_id + f".{derived.format}"
-    fullname = os.path.join(dirname, fname)
+    fname = _make_fname(derived)
 
+    for attempt in range(1, VERIFY_RETRY + 1):
+        try:
+            if job.hedge:
+                size = await _dl_hedged(
+                    client, target_url, fname, header, job
+                )
+            else:
+                size = await _dl_output(
+                    client, target_url, fname, header, job
+                )
+        except IntegrityError as err:
+            #   Broken file is already discarded by its sink.
+            job.log.warning("%s (%d/%d)", err, attempt, VERIFY_RETRY)
+            continue
+        except aiohttp.ServerDisconnectedError as server_err:
+            #   Incomplete file is already discarded by its sink.
+            job.log.critical(
+                "Disconnected by server, one possible reason is the " + \
+                "interval between each connection is too short."
+            )
+            raise server_err
+        else:
+            elapsed = time.perf_counter() - start
+            job.report(derived.illust_id, size, elapsed)
+            return size
+    job.log.error("Give up broken file %s", target_url)
+    return 0
+
+async def _dl_output(client, url, name, headers, job):
+    """ Fetch `url` as file `name` of job output. """
+    sink = job.output.create(name)
     try:
-        async with client.get(target_url, headers=header) as resp:
-            if resp.status == HTTPStatus.NOT_FOUND:
-                pxlog.info("Not found {}".format(target_url))
-                return size
-            resp.raise_for_status()
-            size += await _write_stream(resp, fullname)
-    except aiohttp.ServerDisconnectedError as server_err:
-        if os.path.exists(fullname):
-            #   Clean up possible incomplete file.
-            os.remove(fullname)
-        pxlog.critical(
-            "Disconnected by server, one possible reason is the interval" + \
-            "between each connection is too short."
+        size = await _dl_attempt(
+            client, url, sink.file, headers, job.log, limiters=job.limiters
         )
-        raise server_err
-    else:
-        elapsed = time.perf_counter() - start
-        pxlog.info(
-            "{file:14s} {size:10s} {elapsed:>4.1f} s".format(
-                file=derived.illust_id, size=byte2human(size), elapsed=elapsed
+    except:
+        sink.abort()
+        raise
+    await _finish_sink(sink, name, url, size, job)
+    return size
+
+@_staged
+async def _finish_sink(sink, name, url, size, job):
+    """ Commit `sink` if the file is valid, abort it otherwise. """
+    if not size:
+        #   Not found.
+        sink.abort()
+        return
+    if not _check_file(sink.file, name.rsplit(".", maxsplit=1)[-1]):
+        sink.abort()
+        raise IntegrityError(f"Broken file: {url}")
+    data = None
+    if job.post is not None and job.post.wants_data(sink.path, size):
+        #   Still in memory or page cache, no need to read from disk later.
+        data = sink.file.read()
+    sink.commit()
+    if job.post is not None:
+        #   Still holding a connection, submitted by "_dl_fetcher".
+        job.post.defer(name, sink.path, data)
+
+@_staged
+async def _dl_attempt(
+        client, url, f, headers, log=pxlog, progress=None, limiters=()
+    ):
+    """ Fetch `url` into file object `f`, returns 0 if not found.
+
+    The response to the first range is kept as the first segment, large
+    files cost no request only to learn their size. It is cut to an even
+    share of the file, so no segment lags behind the others.
+    """
+    hdr = dict(headers, Range=f"bytes=0-{SEGMENT_THRESHOLD - 1}")
+    async with client.get(url, headers=hdr) as resp:
+        if resp.status == HTTPStatus.NOT_FOUND:
+            log.info("Not found %s", url)
+            return 0
+        resp.raise_for_status()
+        #   None if the range is ignored, the whole file is coming.
+        total = _range_total(resp)
+        if total is None or total <= SEGMENT_THRESHOLD:
+            n = await _write_stream(
+                resp, f, progress=progress, limiters=limiters
+            )
+            _check_length(resp, n, url)
+            return n
+        if progress is not None:
+            progress.segmented = True
+        head_len = min(SEGMENT_THRESHOLD, math.ceil(total / SEGMENT_COUNT))
+
+        async def first_segment():
+            n = await _write_stream(
+                resp, f, progress=progress, limiters=limiters, limit=head_len
+            )
+            if n != head_len:
+                raise IntegrityError(f"Received {n}/{head_len} bytes: {url}")
+            if resp.content_length is None or n < resp.content_length:
+                #   Rest of the range is fetched by other segments, drop
+                #   the connection instead of reading it.
+                resp.close()
+            return n
+
+        gat = asyncio.gather(
+            first_segment(),
+            _dl_segmented(
+                client, url, f, head_len, total, headers, log, limiters
+            ),
+            loop=_loop
+        )
+        try:
+            head, rest = await gat
+        except:
+            gat.cancel()
+            raise
+    return head + rest
+
+def _check_length(resp, n, url):
+    """ Raise if `n` bytes received differs from length of `resp`. """
+    expected = resp.content_length
+    if ("Content-Encoding" not in resp.headers
+            and expected is not None and n != expected):
+        raise IntegrityError(f"Received {n}/{expected} bytes: {url}")
+
+@_staged
+async def _dl_hedged(client, url, name, headers, job):
+    """ Race a duplicate against a stalled request, the first one wins. """
+    log = job.log
+    attempts = dict()
+
+    def launch():
+        progress = _Progress()
+        sink = job.output.create(name)
+        task = _loop.create_task(
+            _dl_attempt(
+                client, url, sink.file, headers, log, progress, job.limiters
             )
         )
+        attempts[task] = (sink, progress)
+
+    launch()
+    primary = next(iter(attempts))
+    pending = set(attempts)
+    winner = None
+    try:
+        #   Check the original request once per delay until it is done or a
+        #   duplicate is issued.
+        while len(attempts) == 1 and not primary.done():
+            await asyncio.wait(pending, timeout=_hedger.delay(), loop=_loop)
+            _, progress = attempts[primary]
+            if (not primary.done() and _hedger.is_slow(progress)
+                    and _hedger.acquire()):
+                log.debug("Hedging %s", url)
+                launch()
+        pending = set(attempts)
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED, loop=_loop
+            )
+            for task in done:
+                if task.exception() is None:
+                    winner = task
+                    break
+            if winner is not None:
+                break
+        if winner is None:
+            #   Every attempt failed, report the original error.
+            return primary.result()
+    finally:
+        for task, (sink, progress) in attempts.items():
+            _hedger.record(progress)
+            if task is not winner:
+                task.cancel()
+        if pending:
+            await asyncio.wait(pending, loop=_loop)
+        for task, (sink, _) in attempts.items():
+            if task is not winner:
+                sink.abort()
+    sink, _ = attempts[winner]
+    size = winner.result()
+    await _finish_sink(sink, name, url, size, job)
     return size
 
-async def _write_stream(resp, fpath, chunk_size=4096):
+@_staged
+async def _write_stream(
+        resp, f, chunk_size=4096, progress=None, limiters=(), pos=0,
+        limit=None
+    ):
+    """ Write body of `resp` into `f` from offset `pos`, at most `limit`
+    bytes if given. """
     n = 0
     reader = resp.content
-    with open(fpath, "wb") as f:
-        async for chunk in reader.iter_chunked(chunk_size):
-            n += f.write(chunk)
+    async for chunk in reader.iter_chunked(chunk_size):
+        if limit is not None:
+            chunk = chunk[:limit - n]
+        #   No await in between, concurrent segments never interleave.
+        f.seek(pos + n)
+        n += f.write(chunk)
+        if progress is not None:
+            progress.feed(len(chunk))
+        #   Not reading further holds back the sender through TCP window.
+        await _throttle(limiters, len(chunk))
+        if limit is not None and n >= limit:
+            break
     return n
 
+def _range_total(resp):
+    """ Total size from "Content-Range" of `resp`, None if not known. """
+    if resp.status != HTTPStatus.PARTIAL_CONTENT:
+        return None
+    total = resp.headers.get("Content-Range", "").rpartition("/")[2]
+    return int(total) if total.isdigit() else None
+
+@_staged
+async def _dl_segmented(
+        client, url, f, start, length, headers, log=pxlog, limiters=()
+    ):
+    """ Fetch bytes from `start` to the end of `url` in ranges
+    concurrently into a preallocated file. """
+    seg_len = math.ceil((length - start) / max(1, SEGMENT_COUNT - 1))
+    ranges = [
+        (first, min(first + seg_len, length) - 1)
+        for first in range(start, length, seg_len)
+    ]
+    log.debug("Fetching %s in %d segments", url, len(ranges))
+    f.truncate(length)
+    gat = asyncio.gather(
+        *(
+            _dl_segment(
+                client, url, f, first, last, headers, log, limiters
+            )
+            for first, last in ranges
+        ),
+        loop=_loop
+    )
+    try:
+        sizes = await gat
+    except:
+        gat.cancel()
+        raise
+    return sum(sizes)
+
+@_staged
+async def _dl_segment(
+        client, url, f, first, last, headers, log=pxlog, limiters=(),
+        chunk_size=4096
+    ):
+    """ Fetch bytes `first` to `last` of `url` into `f` at their offset. """
+    pos = first
+    for attempt in range(1, SEGMENT_RETRY + 1):
+        hdr = dict(headers, Range=f"bytes={pos}-{last}")
+        try:
+            async with client.get(url, headers=hdr) as resp:
+                resp.raise_for_status()
+                if resp.status != HTTPStatus.PARTIAL_CONTENT:
+                    raise RuntimeError(f"Range request ignored: {url}")
+                reader = resp.content
+                async for chunk in reader.iter_chunked(chunk_size):
+                    #   No await in between, segments never interleave.
+                    f.seek(pos)
+                    pos += f.write(chunk)
+                    await _throttle(limiters, len(chunk))
+        except (aiohttp.ClientPayloadError,
+                aiohttp.ClientConnectionError,
+                asyncio.TimeoutError) as err:
+            if attempt == SEGMENT_RETRY:
+                raise
+            log.debug("Segment %d-%d of %s failed: %r", pos, last, url, err)
+        if pos > last:
+            return pos - first
+    raise aiohttp.ClientPayloadError(
+        f"Segment {first}-{last} of {url} is incomplete"
+    )
+
 #---------------------------------------------------------------------------#
 #   Helpers                                                                 #
 #---------------------------------------------------------------------------#
 
+def _check_magic(head, tail, ext):
+    """ Check leading magic bytes and trailer of file format `ext`. """
+    if not (ext in _MAGICS):
+        return True
+    magics, trailer = _MAGICS[ext]
+    return head.startswith(magics) and trailer in tail
+
+@_staged
+def _check_file(f, ext):
+    """ Check magic bytes of readable and seekable file object `f`. """
+    size = f.seek(0, io.SEEK_END)
+    f.seek(0)
+    head = f.read(_HEAD_BYTES)
+    f.seek(max(0, size - _TAIL_BYTES.get(ext, _DEFAULT_TAIL_BYTES)))
+    tail = f.read()
+    f.seek(0)
+    return _check_magic(head, tail, ext)
+
+def _make_fname(derived):
+    return derived.illust_id + f".{derived.format}"
+
+def _share_file(src, dst):
+    """ Hardlink `src` to `dst`, fallback to copy across filesystems. """
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
 def _make_query(date="", mode="daily", content="", pages=-1):
     if not (mode in AVAILABLE_MODES):
         raise ValueError(f"Unknown mode: {mode}")
@@ -800,6 +3003,17 @@ def _make_most_recent_date():
     date = local_now - datetime.timedelta(days=delta)
     return date.strftime("%Y%m%d")
 
+def _shift_date(date, days):
+    d = datetime.datetime.strptime(date, "%Y%m%d")
+    return (d + datetime.timedelta(days=days)).strftime("%Y%m%d")
+
+def _iter_dates(begin, end):
+    date = begin
+    while date <= end:
+        yield date
+        date = _shift_date(date, 1)
+
+@_staged
 def _merge_json(
         texts,
         merge_key=lambda x: x["contents"],
@@ -0,0 +1,109 @@
+import datetime
+import unittest
+from unittest import mock
+
+from pxvtool import pypxv
+
+RATE = 1000
+
+
+def clock(minutes):
+    """ "HH:MM" of `minutes` from now, local time. """
+    t = datetime.datetime.now() + datetime.timedelta(minutes=minutes)
+    return t.strftime("%H:%M")
+
+
+class TokenBucketTest(unittest.TestCase):
+    def setUp(self):
+        self.slept = []
+
+    async def sleep(self, delay, *, loop=None):
+        self.slept.append(delay)
+
+    def consume(self, bucket, *ns):
+        with mock.patch.object(pypxv.asyncio, "sleep", self.sleep):
+            for n in ns:
+                pypxv._loop.run_until_complete(bucket.consume(n))
+
+    def test_unlimited(self):
+        bucket = pypxv._TokenBucket()
+        self.consume(bucket, 10 ** 9, 10 ** 9)
+        self.assertEqual(bucket.rate, 0)
+        self.assertEqual(self.slept, [])
+
+    def test_capacity(self):
+        bucket = pypxv._TokenBucket(RATE)
+        self.assertEqual(
+            bucket._capacity(), RATE * pypxv.BANDWIDTH_BURST_SECONDS
+        )
+        bucket = pypxv._TokenBucket(RATE, burst=5 * RATE)
+        self.assertEqual(bucket._capacity(), 5 * RATE)
+
+    def test_burst_not_waited(self):
+        bucket = pypxv._TokenBucket(RATE, burst=2 * RATE)
+        self.consume(bucket, RATE, RATE // 2)
+        self.assertEqual(self.slept, [])
+
+    def test_deficit_waited(self):
+        bucket = pypxv._TokenBucket(RATE, burst=RATE)
+        self.consume(bucket, RATE, RATE, RATE // 2)
+        #   Deficit grows with each chunk, short of refills in between.
+        self.assertEqual(len(self.slept), 2)
+        self.assertAlmostEqual(self.slept[0], 1.0, places=2)
+        self.assertAlmostEqual(self.slept[1], 1.5, places=2)
+
+    def test_schedule_overrides_rate(self):
+        bucket = pypxv._TokenBucket(RATE, schedule=[
+            (clock(60), clock(120), 10 * RATE),
+            (clock(-60), clock(60), 2 * RATE),
+            (clock(-120), clock(120), 3 * RATE),
+        ])
+        #   First window covering now wins.
+        self.assertEqual(bucket.rate, 2 * RATE)
+        self.assertEqual(bucket._capacity(), 2 * RATE)
+
+    def test_schedule_not_covering(self):
+        bucket = pypxv._TokenBucket(RATE, schedule=[
+            (clock(60), clock(120), 0)
+        ])
+        self.assertEqual(bucket.rate, RATE)
+
+    def test_schedule_unlimited(self):
+        bucket = pypxv._TokenBucket(RATE, schedule=[
+            (clock(-60), clock(60), 0)
+        ])
+        self.consume(bucket, 10 * RATE)
+        self.assertEqual(bucket.rate, 0)
+        self.assertEqual(self.slept, [])
+
+    def test_in_window(self):
+        day = pypxv._parse_clock("09:00"), pypxv._parse_clock("18:00")
+        self.assertTrue(pypxv._in_window((9, 0), *day))
+        self.assertTrue(pypxv._in_window((17, 59), *day))
+        self.assertFalse(pypxv._in_window((18, 0), *day))
+        self.assertFalse(pypxv._in_window((8, 59), *day))
+        night = pypxv._parse_clock("23:00"), pypxv._parse_clock("07:30")
+        self.assertTrue(pypxv._in_window((23, 30), *night))
+        self.assertTrue(pypxv._in_window((0, 0), *night))
+        self.assertTrue(pypxv._in_window((7, 29), *night))
+        self.assertFalse(pypxv._in_window((7, 30), *night))
+        self.assertFalse(pypxv._in_window((12, 0), *night))
+
+    def test_settings(self):
+        schedule = [("09:00", "18:00", RATE)]
+        bucket = pypxv._TokenBucket(RATE, 2 * RATE, schedule)
+        settings = bucket.settings
+        self.assertEqual(
+            settings, dict(rate=RATE, burst=2 * RATE, schedule=schedule)
+        )
+        other = pypxv._TokenBucket(**settings)
+        self.assertEqual(other.settings, settings)
+        bucket.configure()
+        self.assertEqual(
+            bucket.settings, dict(rate=0, burst=None, schedule=None)
+        )
+        self.assertEqual(bucket.rate, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
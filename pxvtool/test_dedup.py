@@ -0,0 +1,94 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from pxvtool import dedup
+
+#   Same size, different content, never grouped with `IMAGE`.
+IMAGE = b"\xff\xd8\xff" + b"a" * 1021
+OTHER = b"\xff\xd8\xff" + b"b" * 1021
+
+
+class DedupTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.copies = [
+            self.write(d, "1_p0.jpg", IMAGE) for d in ("a", "b", "c")
+        ]
+        self.other = self.write("a", "2_p0.jpg", OTHER)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def write(self, dirname, name, data):
+        path = os.path.join(self.root, dirname, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def inodes(self, paths):
+        return {os.stat(p).st_ino for p in paths}
+
+    def test_link_duplicates(self):
+        report = dedup.dedup_library(self.root, workers=1)
+        self.assertEqual(report.files, 4)
+        self.assertEqual(report.hashed, 4)
+        self.assertEqual(report.groups, 1)
+        self.assertEqual(report.linked, 2)
+        self.assertEqual(report.reclaimed, 2 * len(IMAGE))
+        self.assertEqual(len(self.inodes(self.copies)), 1)
+        self.assertNotIn(
+            os.stat(self.other).st_ino, self.inodes(self.copies)
+        )
+        for path in self.copies:
+            with open(path, "rb") as f:
+                self.assertEqual(f.read(), IMAGE)
+        self.assertFalse(
+            [n for _, _, names in os.walk(self.root) for n in names
+                if n.endswith(".dedup")]
+        )
+
+    def test_dry_run(self):
+        report = dedup.dedup_library(self.root, workers=1, dry_run=True)
+        self.assertEqual(report.groups, 1)
+        self.assertEqual(report.linked, 2)
+        self.assertEqual(report.reclaimed, 2 * len(IMAGE))
+        self.assertEqual(len(self.inodes(self.copies)), 3)
+
+    def test_shared_inode(self):
+        a, b, c = self.copies
+        os.remove(b)
+        os.link(a, b)
+        report = dedup.dedup_library(self.root, workers=1)
+        #   Inode linked twice is kept, only `c` is replaced.
+        self.assertEqual(report.groups, 1)
+        self.assertEqual(report.linked, 1)
+        self.assertEqual(report.reclaimed, len(IMAGE))
+        self.assertEqual(self.inodes(self.copies), {os.stat(a).st_ino})
+
+    def test_already_shared(self):
+        a, b, c = self.copies
+        for path in (b, c):
+            os.remove(path)
+            os.link(a, path)
+        os.remove(self.other)
+        report = dedup.dedup_library(self.root, workers=1)
+        #   One inode, nothing to compare.
+        self.assertEqual(report.hashed, 0)
+        self.assertEqual(report.groups, 0)
+        self.assertEqual(report.linked, 0)
+        self.assertEqual(report.reclaimed, 0)
+
+    def test_reclaimed_needs_every_link(self):
+        a, b, c = self.copies
+        #   A link outside of the library keeps the data of `c` alive.
+        os.link(c, os.path.join(self.root, "c", "keep.bin"))
+        report = dedup.dedup_library(self.root, workers=1)
+        self.assertEqual(report.linked, 2)
+        self.assertEqual(report.reclaimed, len(IMAGE))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,110 @@
+import asyncio
+import unittest
+
+from pxvtool import pypxv
+
+
+def run(coro):
+    return pypxv._loop.run_until_complete(coro)
+
+
+class SingleFlightTest(unittest.TestCase):
+    def setUp(self):
+        self.flights = pypxv._SingleFlight()
+        self.calls = 0
+        self.release = asyncio.Event(loop=pypxv._loop)
+
+    async def work(self, value):
+        self.calls += 1
+        await self.release.wait()
+        return value
+
+    async def fail(self):
+        self.calls += 1
+        await self.release.wait()
+        raise KeyError("lost")
+
+    def start(self, func, *args, key="k"):
+        return pypxv._loop.create_task(self.flights.do(key, func, *args))
+
+    async def settle(self):
+        #   Let started callers reach the flight.
+        for _ in range(3):
+            await asyncio.sleep(0, loop=pypxv._loop)
+
+    def test_shared(self):
+        async def main():
+            first = self.start(self.work, 1)
+            second = self.start(self.work, 2)
+            await self.settle()
+            self.release.set()
+            return await first, await second
+
+        self.assertEqual(run(main()), ((1, False), (1, True)))
+        self.assertEqual(self.calls, 1)
+        self.assertFalse(self.flights._flights)
+
+    def test_other_keys(self):
+        async def main():
+            first = self.start(self.work, 1, key="a")
+            second = self.start(self.work, 2, key="b")
+            await self.settle()
+            self.release.set()
+            return await first, await second
+
+        self.assertEqual(run(main()), ((1, False), (2, False)))
+        self.assertEqual(self.calls, 2)
+
+    def test_called_again_after_landing(self):
+        self.release.set()
+        self.assertEqual(run(self.flights.do("k", self.work, 1)), (1, False))
+        self.assertEqual(run(self.flights.do("k", self.work, 2)), (2, False))
+        self.assertEqual(self.calls, 2)
+
+    def test_exception_shared(self):
+        async def main():
+            first = self.start(self.fail)
+            second = self.start(self.fail)
+            await self.settle()
+            self.release.set()
+            return await asyncio.gather(
+                first, second, return_exceptions=True, loop=pypxv._loop
+            )
+
+        results = run(main())
+        self.assertTrue(all(isinstance(r, KeyError) for r in results))
+        self.assertEqual(self.calls, 1)
+
+    def test_leader_cancelled(self):
+        async def main():
+            leader = self.start(self.work, 1)
+            follower = self.start(self.work, 2)
+            await self.settle()
+            leader.cancel()
+            await self.settle()
+            self.release.set()
+            return leader, await follower
+
+        leader, res = run(main())
+        #   The call goes on for the follower.
+        self.assertTrue(leader.cancelled())
+        self.assertEqual(res, (1, True))
+        self.assertEqual(self.calls, 1)
+
+    def test_every_caller_cancelled(self):
+        async def main():
+            callers = [self.start(self.work, 1) for _ in range(2)]
+            await self.settle()
+            flight = self.flights._flights["k"]
+            for caller in callers:
+                caller.cancel()
+            await self.settle()
+            return flight
+
+        flight = run(main())
+        self.assertTrue(flight.task.cancelled())
+        self.assertFalse(self.flights._flights)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,116 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from pxvtool import lease
+from pxvtool import pypxv
+
+DIRNAME = "out"
+
+
+class WorkQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.queue = lease.WorkQueue(os.path.join(self.tmpdir, "queue.db"))
+
+    def tearDown(self):
+        self.queue.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_enqueue_once(self):
+        self.assertEqual(self.queue.enqueue(DIRNAME, [1, 2, 3]), 3)
+        self.assertEqual(self.queue.enqueue(DIRNAME, [3, 4]), 1)
+        self.assertEqual(self.queue.enqueue("other", [3]), 1)
+        self.assertEqual(self.queue.stats(), {lease.PENDING: 5})
+
+    def test_items_round_trip(self):
+        meta = pypxv.NewIllustMeta(
+            70981001, 2,
+            "https://i.pximg.net/img-original/img/2018/10/02/08/04/56/"
+            "70981001_p{page}", pypxv.IllustType.ILLUST
+        )
+        items = [pypxv.NewIllustResolved(meta, "jpg"), 70981002]
+        self.queue.enqueue(DIRNAME, items, task="ranking")
+        claimed = self.queue.claim("w")
+        self.assertEqual(
+            sorted(claimed, key=lambda c: pypxv._illust_key(c[2])),
+            [(DIRNAME, "ranking", item) for item in items]
+        )
+
+    def test_claim(self):
+        self.queue.enqueue(DIRNAME, [1, 2, 3])
+        first = self.queue.claim("a", 2)
+        second = self.queue.claim("b", 2)
+        self.assertEqual(len(first), 2)
+        self.assertEqual(len(second), 1)
+        self.assertEqual(self.queue.claim("c"), [])
+        ids = {item for _, _, item in first + second}
+        self.assertEqual(ids, {1, 2, 3})
+        self.assertEqual(self.queue.stats(), {lease.LEASED: 3})
+        self.assertEqual(self.queue.unfinished(), 3)
+
+    def test_expired_lease_claimed_again(self):
+        self.queue.enqueue(DIRNAME, [1])
+        self.assertEqual(len(self.queue.claim("a", lease=-1)), 1)
+        self.assertEqual(len(self.queue.claim("b")), 1)
+        #   Lease of `a` is gone, its result is ignored.
+        self.assertEqual(self.queue.heartbeat("a", [(DIRNAME, 1)]), set())
+        self.queue.complete("a", [(DIRNAME, 1)])
+        self.assertEqual(self.queue.stats(), {lease.LEASED: 1})
+        self.queue.complete("b", [(DIRNAME, 1)])
+        self.assertEqual(self.queue.stats(), {lease.DONE: 1})
+
+    def test_expired_lease_counts_attempt(self):
+        self.queue.enqueue(DIRNAME, [1])
+        for _ in range(2):
+            claimed = self.queue.claim("a", lease=-1, max_attempts=2)
+            self.assertEqual(len(claimed), 1)
+        self.assertEqual(self.queue.claim("a", max_attempts=2), [])
+        self.assertEqual(self.queue.stats(), {lease.FAILED: 1})
+
+    def test_reclaim(self):
+        self.queue.enqueue(DIRNAME, [1, 2])
+        self.queue.claim("b", 1)
+        self.queue.claim("a", 1, lease=-1)
+        self.assertEqual(self.queue.reclaim(), 1)
+        self.assertEqual(
+            self.queue.stats(), {lease.PENDING: 1, lease.LEASED: 1}
+        )
+        self.assertEqual(self.queue.reclaim(max_attempts=1), 0)
+
+    def test_heartbeat(self):
+        self.queue.enqueue(DIRNAME, [1, 2])
+        self.queue.claim("a")
+        keys = [(DIRNAME, 1), (DIRNAME, 2)]
+        self.assertEqual(self.queue.heartbeat("a", keys), set(keys))
+        self.assertEqual(self.queue.heartbeat("b", keys), set())
+        #   Extended lease is not expired.
+        self.assertEqual(self.queue.reclaim(), 0)
+
+    def test_fail(self):
+        self.queue.enqueue(DIRNAME, [1])
+        key = (DIRNAME, 1)
+        self.queue.claim("a")
+        self.queue.fail("b", [key], max_attempts=2)
+        self.assertEqual(self.queue.stats(), {lease.LEASED: 1})
+        self.queue.fail("a", [key], max_attempts=2)
+        self.assertEqual(self.queue.stats(), {lease.PENDING: 1})
+        self.queue.claim("a")
+        self.queue.fail("a", [key], max_attempts=2)
+        self.assertEqual(self.queue.stats(), {lease.FAILED: 1})
+        self.assertEqual(self.queue.claim("a"), [])
+        self.assertEqual(self.queue.unfinished(), 0)
+
+    def test_release(self):
+        self.queue.enqueue(DIRNAME, [1])
+        key = (DIRNAME, 1)
+        for _ in range(3):
+            self.queue.claim("a", max_attempts=1)
+            self.queue.release("a", [key])
+        #   Releasing is not an attempt.
+        self.assertEqual(self.queue.stats(), {lease.PENDING: 1})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,107 @@
+import json
+import unittest
+
+from pxvtool import pypxv
+
+DATE = "20181002"
+URL = (
+    "https://i.pximg.net/c/240x480/img-master/img/2018/10/02/08/04/56/"
+    "{}_p0_master1200.jpg"
+)
+
+
+def page(p, pages):
+    """ Fake ranking page `p` of `pages` available. """
+    if p > pages:
+        return json.dumps({"error": True, "message": "Not found"})
+    return json.dumps({
+        "date": DATE, "mode": "daily", "next": p + 1 if p < pages else False,
+        "rank_total": pages * pypxv.RANKING_PAGE_SIZE,
+        "contents": [
+            {
+                "illust_id": rank, "rank": rank, "illust_type": "0",
+                "illust_page_count": "1", "url": URL.format(rank)
+            }
+            for rank in range(
+                (p - 1) * pypxv.RANKING_PAGE_SIZE + 1,
+                p * pypxv.RANKING_PAGE_SIZE + 1
+            )
+        ]
+    })
+
+
+class RankingMetasTest(unittest.TestCase):
+    def setUp(self):
+        self.dispatcher = pypxv._query_dispatcher
+        pypxv._query_dispatcher = self.dispatch
+        self.pages = 10
+        self.requested = []
+
+    def tearDown(self):
+        pypxv._query_dispatcher = self.dispatcher
+
+    async def dispatch(self, url, queries, *, headers=dict(), client=None):
+        ps = [int(q["p"]) for q in queries]
+        self.requested.extend(ps)
+        return [page(p, self.pages) for p in ps]
+
+    def fetch(self, **kwargs):
+        date, metas = pypxv._fetch_ranking_metas(DATE, **kwargs)
+        self.assertEqual(date, DATE)
+        return [m.illust_id for m in metas]
+
+    def test_all(self):
+        self.assertEqual(self.fetch(), list(range(1, 501)))
+        self.assertEqual(self.requested, list(range(1, 11)))
+
+    def test_rank_window(self):
+        self.assertEqual(self.fetch(ranks=(51, 120)), list(range(51, 121)))
+        self.assertEqual(self.requested, [2, 3])
+
+    def test_rank_window_in_one_page(self):
+        self.assertEqual(self.fetch(ranks=(60, 70)), list(range(60, 71)))
+        self.assertEqual(self.requested, [2])
+
+    def test_rank_window_beyond_pages(self):
+        self.assertEqual(
+            self.fetch(ranks=(451, 2000)), list(range(451, 501))
+        )
+        self.assertEqual(self.requested, [10])
+
+    def test_ranks_out_of_range(self):
+        with self.assertRaises(ValueError):
+            self.fetch(ranks=(501, 600))
+        self.assertEqual(self.requested, [])
+
+    def test_pages(self):
+        self.assertEqual(self.fetch(pages=2), list(range(1, 101)))
+        self.assertEqual(self.requested, [1, 2])
+
+    def test_targets_stop_early(self):
+        self.assertEqual(self.fetch(targets=(3, 120)), [3, 120])
+        self.assertEqual(self.requested, [1, 2, 3])
+
+    def test_predicates(self):
+        ids = self.fetch(ranks=(1, 100), predicates=[
+            lambda c: c["rank"] % 2 == 0
+        ])
+        self.assertEqual(ids, list(range(2, 101, 2)))
+
+    def test_out_of_pages(self):
+        self.pages = 3
+        self.assertEqual(self.fetch(), list(range(1, 151)))
+
+    def test_out_of_pages_with_targets(self):
+        self.pages = 2
+        self.assertEqual(self.fetch(targets=(1, 400)), [1])
+        self.assertEqual(self.requested, [1, 2])
+
+    def test_first_page_error(self):
+        self.pages = 1
+        with self.assertRaises(Exception):
+            self.fetch(ranks=(51, 100))
+        self.assertEqual(self.requested, [2])
+
+
+if __name__ == "__main__":
+    unittest.main()
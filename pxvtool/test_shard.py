@@ -0,0 +1,112 @@
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+import zipfile
+
+from pxvtool import pypxv
+
+FILES = {
+    "70981001_p0.jpg": b"\xff\xd8\xff" + b"a" * 1000,
+    "70981001_p1.jpg": b"\xff\xd8\xff" + b"b" * 3000,
+    "70981002_p0.png": b"\x89PNG" + b"c" * 10,
+}
+
+
+class ShardOutputTest(unittest.TestCase):
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def save(self, output, name, data):
+        sink = output.create(name)
+        sink.file.write(data)
+        sink.commit()
+
+    def save_all(self, fmt, shard_size=pypxv.SHARD_SIZE):
+        output = pypxv._ShardOutput(self.dirname, fmt, shard_size)
+        for name, data in FILES.items():
+            self.save(output, name, data)
+        output.close()
+
+    def shards(self):
+        return sorted(
+            f for f in os.listdir(self.dirname) if pypxv._pat_shard.match(f)
+        )
+
+    def check_round_trip(self, fmt):
+        self.save_all(fmt)
+        index = pypxv.load_shard_index(self.dirname)
+        self.assertEqual(
+            set(index), {pypxv._shard_key(n) for n in FILES}
+        )
+        for name, data in FILES.items():
+            key = pypxv._shard_key(name)
+            self.assertEqual(index[key]["size"], len(data))
+            self.assertEqual(
+                pypxv.read_shard_member(self.dirname, key, index), data
+            )
+
+    def test_tar_round_trip(self):
+        self.check_round_trip("tar")
+        shard, = self.shards()
+        with tarfile.open(os.path.join(self.dirname, shard)) as tar:
+            for name, data in FILES.items():
+                self.assertEqual(tar.extractfile(name).read(), data)
+
+    def test_zip_round_trip(self):
+        self.check_round_trip("zip")
+        shard, = self.shards()
+        with zipfile.ZipFile(os.path.join(self.dirname, shard)) as zf:
+            for name, data in FILES.items():
+                self.assertEqual(zf.read(name), data)
+
+    def test_roll(self):
+        #   Every file goes beyond the shard size.
+        self.save_all("tar", shard_size=1)
+        self.assertEqual(len(self.shards()), len(FILES))
+        index = pypxv.load_shard_index(self.dirname)
+        for name, data in FILES.items():
+            key = pypxv._shard_key(name)
+            self.assertEqual(
+                pypxv.read_shard_member(self.dirname, key, index), data
+            )
+
+    def test_reopen(self):
+        self.save_all("tar")
+        output = pypxv._ShardOutput(self.dirname, "tar")
+        for name, data in FILES.items():
+            self.assertTrue(output.exists(name))
+            with output.open(name) as f:
+                self.assertEqual(f.read(), data)
+        self.assertFalse(output.exists("70981003_p0.jpg"))
+        self.save(output, "70981003_p0.jpg", b"new")
+        output.close()
+        #   Shards of previous runs are left untouched.
+        self.assertEqual(len(self.shards()), 2)
+        self.assertEqual(
+            pypxv.read_shard_member(self.dirname, "70981003_p0"), b"new"
+        )
+
+    def test_concurrent_writers(self):
+        outputs = [pypxv._ShardOutput(self.dirname, "tar") for _ in range(2)]
+        names = list(FILES)
+        for i, name in enumerate(names):
+            self.save(outputs[i % 2], name, FILES[name])
+        for output in outputs:
+            output.close()
+        #   Both start from the same number, one of them moves on.
+        self.assertEqual(len(self.shards()), 2)
+        index = pypxv.load_shard_index(self.dirname)
+        for name, data in FILES.items():
+            key = pypxv._shard_key(name)
+            self.assertEqual(
+                pypxv.read_shard_member(self.dirname, key, index), data
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
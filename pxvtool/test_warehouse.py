@@ -0,0 +1,112 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from pxvtool import warehouse
+
+DATE = "20181002"
+PAGES = 2
+URL = (
+    "https://i.pximg.net/c/240x480/img-master/img/2018/10/02/08/04/56/"
+    "{}_p0_master1200.jpg"
+)
+
+
+def ranking(p, date=DATE, content=""):
+    """ Fake ranking json of page `p`. """
+    js = {
+        "date": date, "mode": "daily", "content": content,
+        "next": p + 1 if p < PAGES else False,
+        "rank_total": PAGES * 50, "contents": []
+    }
+    for i in range(50):
+        illust_id = p * 1000 + i
+        js["contents"].append({
+            "illust_id": illust_id, "rank": (p - 1) * 50 + i + 1,
+            "title": "t{}".format(illust_id), "user_id": str(i % 5),
+            "user_name": "u{}".format(i % 5), "illust_type": "0",
+            "illust_page_count": "1", "width": 100, "height": 100,
+            "illust_upload_timestamp": 1538435096,
+            "url": URL.format(illust_id), "tags": ["a", "b{}".format(i % 2)],
+            "yes_rank": 0, "view_count": 10, "rating_count": 1
+        })
+    return js
+
+
+class WarehouseTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.wh = warehouse.Warehouse(os.path.join(self.tmpdir, "wh.db"))
+
+    def tearDown(self):
+        self.wh.close()
+        shutil.rmtree(self.tmpdir)
+
+    def count(self, table):
+        return self.wh.query("SELECT COUNT(*) FROM " + table)[0][0]
+
+    def counts(self):
+        return [
+            self.count(t) for t in ("illusts", "rankings", "tags", "ingested")
+        ]
+
+    def test_ingest_idempotent(self):
+        self.assertEqual(self.wh.ingest(ranking(1)), 50)
+        counts = self.counts()
+        self.assertEqual(counts, [50, 50, 100, 1])
+        self.assertEqual(self.wh.ingest(ranking(1)), 50)
+        self.assertEqual(self.counts(), counts)
+
+    def test_pages_merged(self):
+        self.wh.ingest(ranking(1))
+        self.wh.ingest(ranking(2))
+        self.assertEqual(self.counts(), [100, 100, 200, 1])
+        self.assertEqual(
+            self.wh.query("SELECT entries, total FROM ingested"), [(100, 100)]
+        )
+        self.assertEqual(
+            self.wh.query(
+                "SELECT MIN(rank), MAX(rank) FROM rankings WHERE date=?",
+                (DATE,)
+            ),
+            [(1, 100)]
+        )
+
+    def test_has(self):
+        self.assertFalse(self.wh.has(DATE))
+        self.wh.ingest(ranking(1))
+        #   Half of the ranking is not enough.
+        self.assertFalse(self.wh.has(DATE))
+        self.wh.ingest(ranking(2))
+        self.assertTrue(self.wh.has(DATE))
+        self.assertFalse(self.wh.has(DATE, "weekly"))
+        self.assertFalse(self.wh.has("20181003"))
+
+    def test_has_content(self):
+        for p in range(1, PAGES + 1):
+            self.wh.ingest(ranking(p))
+        #   Empty content is stored as "all".
+        self.assertTrue(self.wh.has(DATE, content="all"))
+        self.assertFalse(self.wh.has(DATE, content="illust"))
+        self.wh.ingest(ranking(1, content="illust"))
+        self.assertFalse(self.wh.has(DATE, content="illust"))
+
+    def test_has_without_total(self):
+        js = ranking(1)
+        del js["rank_total"]
+        self.wh.ingest(js)
+        self.assertTrue(self.wh.has(DATE))
+
+    def test_top(self):
+        for p in range(1, PAGES + 1):
+            self.wh.ingest(ranking(p))
+        self.wh.ingest(ranking(1, date="20181001"))
+        users = self.wh.top_users(days=2, end=DATE, limit=1)
+        self.assertEqual(users, [(0, "u0", 30, 1)])
+        self.assertEqual(self.wh.top_users(days=1, end=DATE)[0][2], 20)
+        self.assertEqual(self.wh.top_tags(days=2)[0], ("a", 150))
+
+
+if __name__ == "__main__":
+    unittest.main()
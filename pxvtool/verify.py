@@ -0,0 +1,167 @@
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import re
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from . import pypxv
+from . import summary
+
+#---------------------------------------------------------------------------#
+#   verify                                                                  #
+#       Check downloaded files in parallel, flag or remove broken ones.     #
+#       Results are kept in a manifest, unchanged files are not read        #
+#       again on the next run.                                              #
+#---------------------------------------------------------------------------#
+
+MANIFEST_NAME = ".pxvmanifest.json"
+PXVFILEPAT = r"\d+_p\d+\.(?:{})$".format("|".join(pypxv.COMMON_EXTS))
+
+regpxvfile = re.compile(PXVFILEPAT)
+
+VerifyReport = namedtuple(
+    "VerifyReport", ["checked", "skipped", "bad"]
+)
+
+
+def check_file(path):
+    """
+    Verify a single downloaded file.
+
+    Args:
+        path        `str`
+            Path of file, its extension decides the format checked.
+
+    Returns:
+        tuple of (path, size, mtime, sha256, reason), reason is empty string
+        if the file is valid.
+
+    Raises:
+        OSError
+            File is not readable.
+    """
+    st = os.stat(path)
+    ext = path.rsplit(".", maxsplit=1)[-1].lower()
+    if st.st_size == 0:
+        return path, 0, st.st_mtime, "", "empty"
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            head = mm[:pypxv._HEAD_BYTES]
+            tail_bytes = pypxv._TAIL_BYTES.get(
+                ext, pypxv._DEFAULT_TAIL_BYTES
+            )
+            tail = mm[max(0, len(mm) - tail_bytes):]
+            h.update(mm)
+    reason = "" if pypxv._check_magic(head, tail, ext) else "broken"
+    return path, st.st_size, st.st_mtime, h.hexdigest(), reason
+
+def file_digest(path):
+    """ Return (path, sha256 hexdigest) of file, read through mmap. """
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                h.update(mm)
+    return path, h.hexdigest()
+
+def verify_library(
+        root=pypxv.DEFAULT_SAVEDIR, *,
+        workers=None, full=False, remove_bad=False
+    ):
+    """
+    Verify every downloaded file under `root` with a process pool.
+
+    Args:
+        root        `str`
+            Download root, usually "savedir" of download functions.
+        workers     `int`
+            Number of processes, defaults to number of CPUs.
+        full        `bool`
+            Check every file again, ignore manifest.
+        remove_bad  `bool`
+            Remove broken files, so they are downloaded again next time.
+
+    Returns:
+        `VerifyReport`, `bad` is a list of (path, reason).
+
+    Raises:
+        None
+    """
+    manifest_path = os.path.join(root, MANIFEST_NAME)
+    manifest = dict()
+    if not full and os.path.exists(manifest_path):
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+
+    pending = []
+    skipped = 0
+    for path in summary.find_matched(root, regpxvfile):
+        rel = os.path.relpath(path, root)
+        entry = manifest.get(rel)
+        st = os.stat(path)
+        if (entry and entry["ok"] and entry["size"] == st.st_size
+                and entry["mtime"] == st.st_mtime):
+            skipped += 1
+            continue
+        pending.append(path)
+
+    bad = []
+    nproc = workers or os.cpu_count()
+    with ProcessPoolExecutor(workers) as pool:
+        results = pool.map(
+            check_file, pending, chunksize=max(1, len(pending) // (nproc * 8))
+        )
+        for path, size, mtime, digest, reason in results:
+            rel = os.path.relpath(path, root)
+            manifest[rel] = {
+                "size": size, "mtime": mtime, "sha256": digest,
+                "ok": not reason
+            }
+            if not reason:
+                continue
+            bad.append((path, reason))
+            pypxv.pxlog.warning("%s: %s", reason, path)
+            if remove_bad:
+                os.remove(path)
+                del manifest[rel]
+
+    #   Drop entries of files no longer exist.
+    manifest = {
+        rel: entry for rel, entry in manifest.items()
+        if os.path.exists(os.path.join(root, rel))
+    }
+    tmpname = manifest_path + ".tmp"
+    with open(tmpname, "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    os.replace(tmpname, manifest_path)
+    return VerifyReport(len(pending), skipped, bad)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Verify downloaded pixiv images."
+    )
+    parser.add_argument("root", nargs="?", default=pypxv.DEFAULT_SAVEDIR)
+    parser.add_argument("-j", "--workers", type=int, default=None)
+    parser.add_argument(
+        "--full", action="store_true", help="ignore manifest"
+    )
+    parser.add_argument(
+        "--remove", action="store_true", help="remove broken files"
+    )
+    args = parser.parse_args()
+    report = verify_library(
+        args.root, workers=args.workers, full=args.full,
+        remove_bad=args.remove
+    )
+    print(
+        "Checked {}, skipped {}, broken {}".format(
+            report.checked, report.skipped, len(report.bad)
+        )
+    )
+    for path, reason in report.bad:
+        print(f"{reason:8s} {path}")
@@ -0,0 +1,271 @@
+import sqlite3
+
+from . import pypxv
+
+#---------------------------------------------------------------------------#
+#   warehouse                                                               #
+#       Local store of fetched ranking metadata.                            #
+#       Rankings are normalized into illusts, rankings and tags, so         #
+#       historical questions are answered without touching the network.     #
+#---------------------------------------------------------------------------#
+
+DEFAULT_WAREHOUSE = "pixiv_ranking.db"
+
+_schema = """
+CREATE TABLE IF NOT EXISTS illusts (
+    illust_id               INTEGER PRIMARY KEY,
+    title                   TEXT,
+    user_id                 INTEGER,
+    user_name               TEXT,
+    illust_type             TEXT,
+    illust_page_count       INTEGER,
+    width                   INTEGER,
+    height                  INTEGER,
+    illust_upload_timestamp INTEGER,
+    url                     TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_illusts_user ON illusts (user_id);
+
+CREATE TABLE IF NOT EXISTS rankings (
+    date            TEXT,
+    mode            TEXT,
+    content         TEXT,
+    rank            INTEGER,
+    illust_id       INTEGER,
+    yes_rank        INTEGER,
+    view_count      INTEGER,
+    rating_count    INTEGER,
+    PRIMARY KEY (date, mode, content, rank)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_rankings_period
+    ON rankings (mode, content, date);
+CREATE INDEX IF NOT EXISTS idx_rankings_illust ON rankings (illust_id);
+
+CREATE TABLE IF NOT EXISTS tags (
+    illust_id   INTEGER,
+    tag         TEXT,
+    PRIMARY KEY (illust_id, tag)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_tags_tag ON tags (tag);
+
+CREATE TABLE IF NOT EXISTS ingested (
+    date        TEXT,
+    mode        TEXT,
+    content     TEXT,
+    entries     INTEGER,
+    total       INTEGER,
+    PRIMARY KEY (date, mode, content)
+) WITHOUT ROWID;
+"""
+
+_illust_cols = [
+    "illust_id", "title", "user_id", "user_name", "illust_type",
+    "illust_page_count", "width", "height", "illust_upload_timestamp", "url"
+]
+_ranking_cols = [
+    "rank", "illust_id", "yes_rank", "view_count", "rating_count"
+]
+
+
+class Warehouse:
+    """ SQLite store of ranking metadata.
+
+    Pass an instance as `warehouse` of "pypxv.fetch_ranking_info" or
+    "pypxv.download_ranking" to keep every fetched ranking. Downloads
+    ingest from a background thread.
+    """
+    def __init__(self, path=DEFAULT_WAREHOUSE):
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript(_schema)
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def has(self, date, mode="daily", content=""):
+        """ Check if the whole ranking of `date` is already ingested. """
+        cur = self._conn.execute(
+            "SELECT entries, total FROM ingested "
+            "WHERE date=? AND mode=? AND content=?",
+            (date, mode, content or "all")
+        )
+        row = cur.fetchone()
+        return row is not None and (row[1] is None or row[0] >= row[1])
+
+    def ingest(self, js):
+        """
+        Store ranking json from "pypxv.fetch_ranking_info".
+
+        Entries are keyed by date, mode, content and rank, ingesting the
+        same ranking again replaces the previous entries, so it is safe to be
+        repeated. Partial rankings, e.g. a single page, are merged.
+
+        Args:
+            js          `dict`
+                Deserialized ranking json, of one or more pages.
+
+        Returns:
+            int, number of ranking entries stored.
+
+        Raises:
+            None
+        """
+        date = js["date"]
+        mode = js["mode"]
+        content = js.get("content") or "all"
+        contents = js["contents"]
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO illusts VALUES ({})".format(
+                    ",".join("?" * len(_illust_cols))
+                ),
+                (
+                    tuple(_column(c, k) for k in _illust_cols)
+                    for c in contents
+                )
+            )
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO rankings VALUES (?,?,?,{})".format(
+                    ",".join("?" * len(_ranking_cols))
+                ),
+                (
+                    (date, mode, content) +
+                        tuple(_column(c, k) for k in _ranking_cols)
+                    for c in contents
+                )
+            )
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO tags VALUES (?,?)",
+                (
+                    (int(c["illust_id"]), tag)
+                    for c in contents
+                    for tag in c.get("tags", [])
+                )
+            )
+            entries = self._conn.execute(
+                "SELECT COUNT(*) FROM rankings "
+                "WHERE date=? AND mode=? AND content=?",
+                (date, mode, content)
+            ).fetchone()[0]
+            self._conn.execute(
+                "INSERT OR REPLACE INTO ingested VALUES (?,?,?,?,?)",
+                (date, mode, content, entries, js.get("rank_total"))
+            )
+        return len(contents)
+
+    def sync(self, begin, end="", mode="daily", content=""):
+        """
+        Fetch and ingest rankings of dates not ingested yet.
+
+        Args:
+            begin       `str`
+                First date in form of YYYYMMDD.
+            end         `str`
+                Last date in form of YYYYMMDD, most recent if not given.
+            mode        `str`
+                See "pypxv.AVAILABLE_MODES".
+            content     `str`
+                See "pypxv.AVAILABLE_CONTENTS".
+
+        Returns:
+            list of ingested date.
+
+        Raises:
+            Any type of connection error.
+        """
+        if not end:
+            end = pypxv._make_most_recent_date()
+        ingested = []
+        for date in pypxv._iter_dates(begin, end):
+            if self.has(date, mode, content):
+                continue
+            js = pypxv.fetch_ranking_info(date, mode, content)
+            if js.get("error"):
+                pypxv.pxlog.info("Ranking %s unavailable: %s", date, js)
+                continue
+            self.ingest(js)
+            ingested.append(date)
+        return ingested
+
+    def query(self, sql, params=()):
+        """ Run `sql` and return all rows. """
+        return self._conn.execute(sql, params).fetchall()
+
+    def top_users(self, days=90, end="", mode="daily", content="", limit=10):
+        """
+        Users appearing most in rankings within a period.
+
+        Args:
+            days        `int`
+                Length of period in days, ends at `end`.
+            end         `str`
+                Last date in form of YYYYMMDD, latest ingested if not given.
+            mode        `str`
+                See "pypxv.AVAILABLE_MODES".
+            content     `str`
+                See "pypxv.AVAILABLE_CONTENTS".
+            limit       `int`
+                Number of users to return.
+
+        Returns:
+            list of tuple (user_id, user_name, appearances, best_rank).
+
+        Raises:
+            None
+        """
+        period = self._period(days, end, mode, content)
+        if period is None:
+            return []
+        return self.query(
+            """
+            SELECT i.user_id, i.user_name, COUNT(*) AS n, MIN(r.rank)
+            FROM rankings r JOIN illusts i ON r.illust_id = i.illust_id
+            WHERE r.mode=? AND r.content=? AND r.date BETWEEN ? AND ?
+            GROUP BY i.user_id
+            ORDER BY n DESC, MIN(r.rank)
+            LIMIT ?
+            """,
+            (mode, content or "all") + period + (limit,)
+        )
+
+    def top_tags(self, days=90, end="", mode="daily", content="", limit=10):
+        """ Tags appearing most in rankings, see "top_users". """
+        period = self._period(days, end, mode, content)
+        if period is None:
+            return []
+        return self.query(
+            """
+            SELECT t.tag, COUNT(*) AS n
+            FROM rankings r JOIN tags t ON r.illust_id = t.illust_id
+            WHERE r.mode=? AND r.content=? AND r.date BETWEEN ? AND ?
+            GROUP BY t.tag
+            ORDER BY n DESC
+            LIMIT ?
+            """,
+            (mode, content or "all") + period + (limit,)
+        )
+
+    def _period(self, days, end, mode, content):
+        """ Return (begin, end) of period, or None if nothing ingested. """
+        if not end:
+            row = self._conn.execute(
+                "SELECT MAX(date) FROM rankings WHERE mode=? AND content=?",
+                (mode, content or "all")
+            ).fetchone()
+            if row[0] is None:
+                return None
+            end = row[0]
+        return pypxv._shift_date(end, -(days - 1)), end
+
+
+def _column(content, key):
+    value = content.get(key)
+    if key in ("illust_id", "user_id", "illust_page_count") and value:
+        return int(value)
+    return value
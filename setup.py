@@ -11,7 +11,7 @@ setup(
     author="KIodine",
     license="MIT",
     packages=["pxvtool"],
-    python_requires=">=3.6",
+    python_requires=">=3.7",
     install_requires=[
         "aiohttp",
     ],